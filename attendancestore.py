@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+"""
+Local attendance history, for trend queries without touching ChurchSuite.
+
+    python attendancestore.py <db-file> totals
+    python attendancestore.py <db-file> rolling --meeting "Morning" --weeks 4
+    python attendancestore.py <db-file> yoy --meeting "Morning"
+"""
+import argparse
+import sqlite3
+from collections import deque
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS attendance (
+    date TEXT NOT NULL,
+    meeting TEXT NOT NULL,
+    grp TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (date, meeting, grp)
+);
+CREATE INDEX IF NOT EXISTS attendance_series
+    ON attendance (meeting, grp, date);
+"""
+TOTAL_GROUP = 'Total'
+
+
+class AttendanceStore:
+    """
+    SQLite store of attendance counts: one row per date, meeting and group.
+
+    Rows are indexed by (meeting, group, date), so each query below reads a
+    single contiguous series.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def add(self, date, attendance):
+        """
+        Store {meeting: {group: count}} for a date, replacing anything
+        already stored for it
+        """
+        key = date.strftime('%Y-%m-%d')
+        with self.db:
+            self.db.execute("DELETE FROM attendance WHERE date = ?", (key, ))
+            self.db.executemany(
+                "INSERT INTO attendance (date, meeting, grp, count) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    (key, meeting_name, groupname, value)
+                    for meeting_name, meeting_attendance in attendance.items()
+                    for groupname, value in meeting_attendance.items()
+                ),
+            )
+
+    def totals(self, group=TOTAL_GROUP, fromdate=None, todate=None):
+        """
+        Per-meeting (meeting, weeks, sum, average, max) for a group
+        """
+        return self.db.execute(
+            "SELECT meeting, COUNT(*), SUM(count), ROUND(AVG(count), 1), "
+            "MAX(count) FROM attendance "
+            "WHERE grp = ? AND date >= ? AND date <= ? "
+            "GROUP BY meeting ORDER BY meeting",
+            (
+                group,
+                fromdate.strftime('%Y-%m-%d') if fromdate else '',
+                todate.strftime('%Y-%m-%d') if todate else '9999',
+            ),
+        ).fetchall()
+
+    def rolling_average(self, meeting, group=TOTAL_GROUP, weeks=4):
+        """
+        (date, count, average over the last `weeks` recorded dates)
+
+        The average is worked out here rather than with a SQL window
+        function, which needs SQLite 3.25+ (older than many Python 3.6
+        builds link against)
+        """
+        window = deque(maxlen=weeks)
+        rows = []
+        for date, count in self.db.execute(
+                "SELECT date, count FROM attendance "
+                "WHERE meeting = ? AND grp = ? ORDER BY date",
+                (meeting, group)):
+            window.append(count)
+            rows.append((date, count, round(sum(window) / len(window), 1)))
+        return rows
+
+    def year_on_year(self, meeting, group=TOTAL_GROUP):
+        """
+        (date, count, count on the same Sunday a year earlier)
+        """
+        return self.db.execute(
+            "SELECT current.date, current.count, previous.count "
+            "FROM attendance AS current "
+            "LEFT JOIN attendance AS previous "
+            "ON previous.meeting = current.meeting "
+            "AND previous.grp = current.grp "
+            "AND previous.date = date(current.date, '-364 days') "
+            "WHERE current.meeting = ? AND current.grp = ? "
+            "ORDER BY current.date",
+            (meeting, group),
+        ).fetchall()
+
+
+if __name__ == "__main__":
+    from terminaltables import AsciiTable
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('db')
+    parser.add_argument('query', choices=['totals', 'rolling', 'yoy'])
+    parser.add_argument('--meeting')
+    parser.add_argument('--group', default=TOTAL_GROUP)
+    parser.add_argument('--weeks', type=int, default=4)
+    args = parser.parse_args()
+
+    store = AttendanceStore(args.db)
+    if args.query == 'totals':
+        headers = ['Meeting', 'Weeks', 'Sum', 'Average', 'Max']
+        rows = store.totals(args.group)
+    elif not args.meeting:
+        parser.error('--meeting is required for {}'.format(args.query))
+    elif args.query == 'rolling':
+        headers = ['Date', 'Count', '{} week average'.format(args.weeks)]
+        rows = store.rolling_average(args.meeting, args.group, args.weeks)
+    else:
+        headers = ['Date', 'Count', 'Year before']
+        rows = store.year_on_year(args.meeting, args.group)
+    store.close()
+    print(AsciiTable([headers] + [list(row) for row in rows]).table)
@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+"""
+Offline benchmarks for report parsing and rendering.
+
+Generates synthetic ChurchSuite rotas_overview and attendance date_view
+HTML, then times and memory-profiles each stage. Results are printed (or
+written) as JSON, and can be compared against an earlier run:
+
+    python benchmark.py --weeks 52 --teams 30 --output bench.json
+    python benchmark.py --weeks 52 --teams 30 --baseline bench.json
+
+--startup also checks each entry point's cold import time against its
+budget, and that it doesn't load dependencies it has no use for.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+import masterrota
+import sundayreview
+
+ROLES = ['Leader', 'Preacher', 'Vocals', 'Sound', 'Reserve', '']
+REGRESSION_THRESHOLD = 1.5
+# Cold import budget (seconds) for each entry point, and the heavy modules
+# it must not import
+STARTUP_BUDGET = {
+    'cli': 0.05,
+    'scheduler': 0.05,
+    'tagalert': 0.3,
+    'masterrota': 0.4,
+    'sundayreview': 0.8,
+}
+STARTUP_EXCLUDED = {
+    'cli': ['requests', 'lxml', 'googleapiclient', 'emails'],
+    'scheduler': ['requests', 'lxml', 'googleapiclient', 'emails'],
+    'tagalert': ['lxml', 'googleapiclient', 'oauth2client', 'emails'],
+    'masterrota': ['googleapiclient', 'oauth2client', 'emails'],
+}
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+print(json.dumps({{
+    'seconds': time.perf_counter() - started,
+    'modules': sorted(name.split('.')[0] for name in sys.modules),
+}}))
+"""
+
+
+def generate_overview(weeks, teams, members, seed=0):
+    """
+    Synthetic rotas_overview report: a Sunday and a midweek date per week
+    """
+    rand = random.Random(seed)
+    start = date(2018, 1, 7)
+    parts = ['<html><body><div class="rota-report">']
+    for week in range(weeks):
+        sunday = start + timedelta(weeks=week)
+        for day in (sunday, sunday + timedelta(days=3)):
+            parts.append(
+                '<div class="rota-section"><div class="rota-block">'
+                '<h2 class="report_break">{}</h2>'.format(
+                    day.strftime('%A %d %B %Y'))
+            )
+            for team in range(teams):
+                parts.append(
+                    '<div class="rota-date">'
+                    '<span class="date-rota-name">Team {}</span>'
+                    '<ul class="date-members">'.format(team)
+                )
+                for _ in range(rand.randint(1, members)):
+                    parts.append(
+                        '<li class="profile-initial">'
+                        '<span class="profile-name">Person {}</span>'
+                        '<span class="roles">{}</span></li>'.format(
+                            rand.randint(1, 500),
+                            rand.choice(ROLES),
+                        )
+                    )
+                parts.append('</ul></div>')
+            parts.append('</div></div>')
+    parts.append('</div></body></html>')
+    return '\n'.join(parts)
+
+
+def generate_attendance(meetings, groups, seed=0):
+    """
+    Synthetic attendance date_view page
+    """
+    rand = random.Random(seed)
+    parts = ['<html><body>']
+    for meeting in range(meetings):
+        parts.append(
+            '<div class="week-category"><h3>Meeting {}</h3><table>'.format(
+                meeting)
+        )
+        for group in range(groups):
+            parts.append(
+                '<tr><td class="group">Group {}</td>'
+                '<td class="attendance">{}</td></tr>'.format(
+                    group,
+                    rand.choice([rand.randint(0, 300), '']),
+                )
+            )
+        parts.append('</table></div>')
+    parts.append('</body></html>')
+    return '\n'.join(parts)
+
+
+def measure(func, repeat):
+    """
+    Run func repeat times, returning (result, best seconds, peak KiB)
+    """
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak / 1024
+
+
+def run(args):
+    overview = generate_overview(args.weeks, args.teams, args.members)
+    attendance = generate_attendance(args.meetings, args.groups)
+    timestamp = '2018-01-01 00:00'
+    stages = {}
+
+    def record(name, func):
+        result, seconds, peak_kb = measure(func, args.repeat)
+        stages[name] = {
+            'seconds': round(seconds, 6),
+            'peak_kb': round(peak_kb, 1),
+        }
+        print('{:<16} {:>10.4f}s {:>12.1f} KiB'.format(
+            name, seconds, peak_kb), file=sys.stderr)
+        return result
+
+    master = record('parse', lambda: masterrota.parse_dates(overview))
+    dataset = record('organise', lambda: masterrota.build_dataset(master))
+    record('sheet_rows', lambda: masterrota.overview_rows(
+        dataset, timestamp))
+
+    def render():
+        nicedate, _, rows = masterrota.next_sunday_rows(dataset, timestamp)
+        return dataset.html, masterrota.render_next_html(
+            rows, nicedate, 'example', 'sheetid')
+
+    record('render_html', render)
+    record('attendance', lambda: sundayreview.parse_attendance(attendance))
+
+    return {
+        'python': platform.python_version(),
+        'params': {
+            'weeks': args.weeks,
+            'teams': args.teams,
+            'members': args.members,
+            'meetings': args.meetings,
+            'groups': args.groups,
+            'repeat': args.repeat,
+        },
+        'sizes': {
+            'overview_bytes': len(overview),
+            'attendance_bytes': len(attendance),
+            'dates': len(master),
+        },
+        'stages': stages,
+    }
+
+
+def measure_startup(repeat):
+    """
+    Best cold import time of each entry point, in a fresh interpreter
+    each time. Returns (results, names of entry points over budget or
+    importing excluded modules).
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    failures = []
+    for module, budget in STARTUP_BUDGET.items():
+        best = None
+        for _ in range(repeat):
+            output = subprocess.check_output(
+                [sys.executable, '-c', STARTUP_SCRIPT.format(module=module)],
+                cwd=here,
+            )
+            result = json.loads(output.decode('utf-8').splitlines()[-1])
+            if best is None or result['seconds'] < best:
+                best = result['seconds']
+        excluded = [
+            name for name in STARTUP_EXCLUDED.get(module, [])
+            if name in result['modules']
+        ]
+        results[module] = {
+            'seconds': round(best, 6),
+            'budget': budget,
+            'excluded_imports': excluded,
+        }
+        ok = best <= budget and not excluded
+        print('{:<16} {:>10.4f}s {:>8.2f}s budget {}'.format(
+            module, best, budget,
+            'ok' if ok else 'FAILED {}'.format(' '.join(excluded)),
+        ), file=sys.stderr)
+        if not ok:
+            failures.append(module)
+    return results, failures
+
+
+def compare(report, baseline, threshold):
+    """
+    Print per-stage timing ratios against a baseline report.
+    Returns the names of stages slower than the threshold.
+    """
+    if baseline['params'] != report['params']:
+        print('Warning: baseline was run with different parameters',
+              file=sys.stderr)
+    regressions = []
+    for name, stage in report['stages'].items():
+        before = baseline['stages'].get(name)
+        if not before or not before['seconds']:
+            continue
+        ratio = stage['seconds'] / before['seconds']
+        print('{:<16} {:>6.2f}x'.format(name, ratio), file=sys.stderr)
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--weeks', type=int, default=52)
+    parser.add_argument('--teams', type=int, default=15)
+    parser.add_argument('--members', type=int, default=4,
+                        help='maximum members per rota')
+    parser.add_argument('--meetings', type=int, default=4)
+    parser.add_argument('--groups', type=int, default=15)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the JSON report here')
+    parser.add_argument('--baseline', help='JSON report to compare against')
+    parser.add_argument('--threshold', type=float,
+                        default=REGRESSION_THRESHOLD,
+                        help='slowdown ratio treated as a regression')
+    parser.add_argument('--startup', action='store_true',
+                        help='check cold import times against the budget')
+    args = parser.parse_args()
+
+    report = run(args)
+    startup_failures = []
+    if args.startup:
+        report['startup'], startup_failures = measure_startup(args.repeat)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print('Regressions: {}'.format(', '.join(regressions)),
+                  file=sys.stderr)
+            sys.exit(1)
+    if startup_failures:
+        print('Over startup budget: {}'.format(', '.join(startup_failures)),
+              file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,48 @@
+import json
+import os
+import time
+
+CACHE_DIR = '.cache'
+
+
+def get_cache_path(filename):
+    """
+    Path to a file in the local cache directory (created on demand)
+    """
+    cache_dir = os.path.join(os.getcwd(), CACHE_DIR)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    return os.path.join(cache_dir, filename)
+
+
+def is_fresh(path, max_age):
+    """
+    True if the file at path exists and is younger than max_age seconds
+    """
+    try:
+        return time.time() - os.path.getmtime(path) < max_age
+    except OSError:
+        return False
+
+
+def load_json(filename, default=None):
+    """
+    Load a JSON file from the cache directory, or default if it's missing
+    or unreadable
+    """
+    try:
+        with open(get_cache_path(filename), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(filename, data):
+    """
+    Atomically write JSON to a file in the cache directory
+    """
+    path = get_cache_path(filename)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
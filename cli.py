@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+"""
+Single entry point for the ChurchSuite tools.
+
+    python cli.py masterrota <config-file> [--notify] [--full] [--test]
+    python cli.py sundayreview <config-file> [--date YYYY-MM-DD]
+    python cli.py tagalert <config-file>
+    python cli.py scheduler <scheduler-config> [--once]
+
+Each command imports only the modules it needs, so e.g. tagalert runs
+never load the Google API client.
+"""
+import argparse
+import json
+import sys
+from datetime import datetime
+
+import metrics
+
+
+def load_config(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def masterrota(args):
+    import masterrota
+    from sessioncache import LoginError
+    config = load_config(args.config)
+    try:
+        ok = masterrota.run_config(
+            config,
+            notify=args.notify,
+            full=args.full,
+            test=args.test,
+        )
+    except LoginError as e:
+        print('Error - {}'.format(e))
+        return False
+    metrics.write_report(config, 'masterrota')
+    return ok
+
+
+def sundayreview(args):
+    import sundayreview
+    from sessioncache import LoginError
+    config = load_config(args.config)
+    try:
+        if args.backfill:
+            sundayreview.backfill(
+                config,
+                args.backfill,
+                args.to or sundayreview.get_last_sunday(),
+            )
+        else:
+            sundayreview.review(
+                config,
+                args.date or sundayreview.get_last_sunday(),
+                args.refresh_responses,
+            )
+    except LoginError as e:
+        print('Error - {}'.format(e))
+        return False
+    metrics.write_report(config, 'sundayreview')
+
+
+def tagalert(args):
+    import tagalert
+    config = load_config(args.config)
+    ok = tagalert.run_config(config)
+    metrics.write_report(config, 'tagalert')
+    return ok
+
+
+def scheduler(args):
+    import scheduler
+    jobs = scheduler.load_jobs(args.config)
+    if args.once:
+        return scheduler.run_once(jobs)
+    try:
+        scheduler.run_forever(jobs)
+    except KeyboardInterrupt:
+        scheduler.log('Stopped')
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    command = commands.add_parser('masterrota')
+    command.add_argument('config')
+    command.add_argument('--notify', action='store_true')
+    command.add_argument('--full', action='store_true')
+    command.add_argument('--test', action='store_true')
+    command.set_defaults(func=masterrota)
+
+    command = commands.add_parser('sundayreview')
+    command.add_argument('config')
+    command.add_argument('--date', type=parse_date)
+    command.add_argument('--backfill', type=parse_date, metavar='FROM')
+    command.add_argument('--to', type=parse_date)
+    command.add_argument('--refresh-responses', action='store_true')
+    command.set_defaults(func=sundayreview)
+
+    command = commands.add_parser('tagalert')
+    command.add_argument('config')
+    command.set_defaults(func=tagalert)
+
+    command = commands.add_parser('scheduler')
+    command.add_argument('config')
+    command.add_argument('--once', action='store_true')
+    command.set_defaults(func=scheduler)
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    if args.func(args) is False:
+        sys.exit(1)
+    print('Done')
@@ -0,0 +1,56 @@
+"""
+Helpers shared by the ChurchSuite scripts. Kept free of the parsing, Google
+and email dependencies, so importing it is cheap.
+"""
+from datetime import datetime
+
+import metrics
+import replay
+from sessioncache import ChurchSuiteSession
+
+# Logged-in sessions, by (churchname, username, siteid)
+_sessions = {}
+
+
+def now():
+    """
+    The current time, or when replaying fixtures, the time they were
+    recorded
+    """
+    return replay.clock() or datetime.now()
+
+
+def get_timestamp():
+    return now().strftime('%Y-%m-%d %H:%M')
+
+
+def get_item_configs(config, key):
+    """
+    Per-item configs from a multi-item config (e.g. 'sites' or 'tags'):
+    each entry in config[key] inherits the shared settings (login, smtp
+    etc) and can override any of them
+    """
+    shared = {
+        name: value for name, value in config.items() if name != key
+    }
+    return [dict(shared, **item) for item in config[key]]
+
+
+@metrics.timed('login')
+def login(churchname, username, password, siteid=None):
+    """
+    Login to churchsuite
+
+    The session is cached on disk and reused by later runs until
+    ChurchSuite rejects it (see sessioncache.ChurchSuiteSession). Each site
+    has its own session, as the current site is server-side session state.
+    Within a process (e.g. under scheduler.py) the same session object is
+    reused. Raises sessioncache.LoginError if the login is refused.
+    """
+    key = (churchname, username, siteid)
+    session = _sessions.get(key)
+    if session is None or session.password != password:
+        session = ChurchSuiteSession(churchname, username, password, siteid)
+        session.start()
+        _sessions[key] = session
+    return session
@@ -1,7 +1,12 @@
 import argparse
 import os
+import threading
+from collections import OrderedDict
 
+import cache
 import httplib2
+import metrics
+import replay
 from apiclient import discovery
 from oauth2client import client, tools
 from oauth2client.file import Storage
@@ -12,6 +17,16 @@ from oauth2client.file import Storage
 SCOPES = 'https://www.googleapis.com/auth/spreadsheets'
 CLIENT_SECRET_FILE = 'drive_client_secret.json'
 APPLICATION_NAME = 'ChurchApp Master Rota'
+DISCOVERY_URL = 'https://sheets.googleapis.com/$discovery/rest?version=v4'
+DISCOVERY_CACHE_FILE = 'sheets-v4-discovery.json'
+DISCOVERY_MAX_AGE = 7 * 24 * 60 * 60
+
+# Memoized for the life of the process - see get_service
+_credentials = None
+_discovery_document = None
+_fake_http = None
+_lock = threading.Lock()
+_local = threading.local()
 
 
 def get_credentials():
@@ -41,16 +56,170 @@ def get_credentials():
     return credentials
 
 
+def get_discovery_document(http):
+    """
+    Read the Sheets API discovery document from the local cache,
+    downloading it only when missing or stale
+    """
+    path = cache.get_cache_path(DISCOVERY_CACHE_FILE)
+    if cache.is_fresh(path, DISCOVERY_MAX_AGE):
+        with open(path, 'r') as f:
+            return f.read()
+
+    response, content = http.request(DISCOVERY_URL)
+    if response.status != 200:
+        raise IOError('Got {} response from {}'.format(
+            response.status,
+            DISCOVERY_URL,
+        ))
+    document = content.decode('utf-8')
+    with open(path, 'w') as f:
+        f.write(document)
+    return document
+
+
+def count_requests(http):
+    """
+    Count the API requests (and bytes received) made over http in metrics
+    """
+    request = http.request
+
+    def counted_request(*args, **kwargs):
+        response, content = request(*args, **kwargs)
+        metrics.count('sheets_api_calls')
+        metrics.count('sheets_bytes', len(content or b''))
+        return response, content
+
+    http.request = counted_request
+    return http
+
+
+def get_fake_http():
+    """
+    The replay stand-in for Sheets, shared by every thread so they all see
+    the same spreadsheets (and counted in metrics once, when created)
+    """
+    global _fake_http
+    with _lock:
+        if _fake_http is None:
+            _fake_http = count_requests(replay.FakeSheetsHttp())
+        return _fake_http
+
+
 def get_service():
-    credentials = get_credentials()
-    http = credentials.authorize(httplib2.Http())
-    discoveryUrl = ('https://sheets.googleapis.com/$discovery/rest?'
-                    'version=v4')
-    service = discovery.build('sheets', 'v4', http=http,
-                              discoveryServiceUrl=discoveryUrl)
+    """
+    Sheets service for the current thread.
+
+    Credentials and the discovery document are loaded once per process.
+    httplib2 connections can't be shared between threads, so each thread
+    builds its own authorized connection and service once and reuses it.
+    """
+    global _credentials, _discovery_document
+    service = getattr(_local, 'service', None)
+    if service is None and replay.replaying():
+        service = _local.service = discovery.build_from_document(
+            replay.load_discovery_document(),
+            http=get_fake_http(),
+        )
+    elif service is None:
+        with _lock:
+            if _credentials is None:
+                _credentials = get_credentials()
+            http = count_requests(_credentials.authorize(httplib2.Http()))
+            if _discovery_document is None:
+                _discovery_document = get_discovery_document(http)
+        service = _local.service = discovery.build_from_document(
+            _discovery_document,
+            http=http,
+        )
     return service
 
 
+@metrics.timed('sheets_read')
+def read_values(sheetid, range_name):
+    """
+    Current (formatted) values of a range, as a list of rows
+    """
+    sheet_data = get_service().spreadsheets().values().get(
+        spreadsheetId=sheetid,
+        range=range_name,
+    ).execute()
+    return sheet_data.get('values', [])
+
+
+@metrics.timed('sheets_read')
+def read_ranges(sheetid, ranges):
+    """
+    Snapshot several ranges with a single batchGet.
+    Returns {range name: rows} for each requested range.
+    """
+    sheet_data = get_service().spreadsheets().values().batchGet(
+        spreadsheetId=sheetid,
+        ranges=ranges,
+    ).execute()
+    # valueRanges come back in the order requested
+    return {
+        range_name: value_range.get('values', [])
+        for range_name, value_range in zip(
+            ranges, sheet_data.get('valueRanges', []))
+    }
+
+
+class BatchWriter:
+    """
+    Collect cell edits for a spreadsheet and send them in one round-trip.
+
+    Clears are sent (as a single batchClear) before updates (as a single
+    batchUpdate), so a range can be cleared and then rewritten.
+    """
+
+    def __init__(self, sheetid, service=None):
+        self.sheetid = sheetid
+        self.service = service
+        self.clears = []
+        self.updates = OrderedDict()
+
+    def clear(self, range_name):
+        if range_name not in self.clears:
+            self.clears.append(range_name)
+
+    def update(self, range_name, rows):
+        self.updates[range_name] = rows
+
+    def update_cell(self, cellref, data):
+        self.update(cellref, [[data, ], ])
+
+    def flush(self):
+        if not (self.clears or self.updates):
+            return
+        with metrics.timer('sheets_write'):
+            self.send()
+        self.clears = []
+        self.updates = OrderedDict()
+
+    def send(self):
+        service = self.service or get_service()
+        values = service.spreadsheets().values()
+        if self.clears:
+            values.batchClear(
+                spreadsheetId=self.sheetid,
+                body={
+                    'ranges': self.clears,
+                },
+            ).execute()
+        if self.updates:
+            values.batchUpdate(
+                spreadsheetId=self.sheetid,
+                body={
+                    'valueInputOption': 'USER_ENTERED',
+                    'data': [
+                        {'range': range_name, 'values': rows}
+                        for range_name, rows in self.updates.items()
+                    ],
+                },
+            ).execute()
+
+
 if __name__ == "__main__":
     """
     If run from command line, initiate oath2 setup
@@ -0,0 +1,119 @@
+import threading
+import time
+from urllib.parse import urlparse
+
+import metrics
+import replay
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (10, 60)
+POOL_SIZE = 10
+# Requests per second allowed to each host, and the burst allowance
+RATE = 5
+BURST = 10
+RETRIES = 4
+# Retries wait 1s, 2s, 4s, ... (or whatever Retry-After asks for)
+BACKOFF_FACTOR = 1
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+_default_session = None
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: take() blocks until a token is available
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate,
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def get_bucket(host, rate=RATE, burst=BURST):
+    """
+    Rate limiter for a host, shared by every session in the process
+    """
+    with _buckets_lock:
+        bucket = _buckets.get(host)
+        if bucket is None:
+            bucket = _buckets[host] = TokenBucket(rate, burst)
+        return bucket
+
+
+class Session(requests.Session):
+    """
+    requests.Session for talking to ChurchSuite:
+
+    - pooled keep-alive connections (pool_size per host)
+    - a default timeout on every request
+    - retries with exponential backoff on connection errors and 429/5xx
+      responses, honouring Retry-After (idempotent methods only, so
+      logins aren't replayed)
+    - a per-host token bucket rate limit
+    - request and byte counts in metrics
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 rate=RATE, burst=BURST):
+        super().__init__()
+        self.timeout = timeout
+        self.rate = rate
+        self.burst = burst
+        retry = Retry(
+            total=RETRIES,
+            backoff_factor=BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUSES,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=retry,
+        )
+        adapter = replay.adapter(adapter)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        # No need to spare the servers when replaying fixtures
+        self.rate_limited = not replay.replaying()
+        self.hooks['response'].append(metrics.count_response)
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if self.rate_limited:
+            get_bucket(urlparse(url).netloc, self.rate, self.burst).take()
+        return super().request(method, url, *args, **kwargs)
+
+
+def get_session():
+    """
+    Process-wide shared Session, for callers without one of their own
+    """
+    global _default_session
+    with _buckets_lock:
+        if _default_session is None:
+            _default_session = Session()
+        return _default_session
@@ -0,0 +1,167 @@
+import smtplib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+
+import metrics
+import replay
+
+DEFAULT_CONNECTIONS = 1
+DEFAULT_RETRIES = 2
+DEFAULT_TIMEOUT = 30
+OK_STATUS = 250
+
+
+def render(message):
+    """
+    Render an emails.Message to MIME text once, without To or Date headers,
+    so the same body can be sent to every recipient (and kept for reuse)
+    """
+    headers, _, content = message.as_string().replace(
+        '\r\n', '\n').partition('\n\n')
+    headers = '\n'.join(
+        line for line in headers.split('\n')
+        if not line.startswith('Date:')
+    )
+    return headers + '\n\n' + content
+
+
+def address_to(address, body):
+    return ('To: {}\nDate: {}\n{}'.format(
+        address,
+        formatdate(localtime=True),
+        body,
+    )).replace('\n', '\r\n').encode('utf-8')
+
+
+class Mailer:
+    """
+    Sends mail over a small pool of authenticated SMTP connections.
+
+    Takes the 'smtp' section of a tool config. As well as host, port, ssl,
+    user and password, it accepts:
+
+    - connections: number of connections (and parallel sends), default 1
+    - retries: extra attempts per recipient after a failure, default 2
+    - timeout: socket timeout in seconds, default 30
+
+    Connections are opened on first use and kept until close().
+    """
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.connections = max(1, smtp.get('connections',
+                                           DEFAULT_CONNECTIONS))
+        self.retries = smtp.get('retries', DEFAULT_RETRIES)
+        self.local = threading.local()
+        self.clients = []
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def connect(self):
+        if replay.replaying():
+            smtp_class = replay.OutboxSMTP
+        elif self.smtp.get('ssl', False):
+            smtp_class = smtplib.SMTP_SSL
+        else:
+            smtp_class = smtplib.SMTP
+        client = smtp_class(
+            self.smtp.get('host'),
+            self.smtp.get('port', 25),
+            timeout=self.smtp.get('timeout', DEFAULT_TIMEOUT),
+        )
+        if self.smtp.get('user'):
+            client.login(self.smtp['user'], self.smtp.get('password', ''))
+        with self.lock:
+            self.clients.append(client)
+        return client
+
+    def get_client(self):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.connect()
+        return client
+
+    def drop_client(self):
+        client = getattr(self.local, 'client', None)
+        self.local.client = None
+        if client is None:
+            return
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+        try:
+            client.close()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+    def send_one(self, mail_from, address, body):
+        """
+        Send a rendered body to one address, reconnecting and retrying on
+        failure. Returns the SMTP status code (or the error).
+        """
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                self.get_client().sendmail(
+                    mail_from, [address], address_to(address, body))
+                return OK_STATUS
+            except smtplib.SMTPRecipientsRefused as e:
+                # Retrying won't help a refused address
+                return e.recipients[address][0]
+            except (smtplib.SMTPException, OSError) as e:
+                error = e
+                self.drop_client()
+        return getattr(error, 'smtp_code', repr(error))
+
+    def send(self, message, addresses):
+        """
+        Send an emails.Message to each address.
+        Returns {address: status}.
+        """
+        return self.send_rendered(
+            render(message),
+            addresses,
+            mail_from=message.mail_from[1],
+        )
+
+    def send_rendered(self, body, addresses, mail_from=None):
+        """
+        Send a body from render() to each address.
+        Returns {address: status}.
+        """
+        mail_from = self.smtp.get('user') or mail_from
+
+        def send_to(address):
+            status = self.send_one(mail_from, address, body)
+            print('Notifying {} ({})'.format(address, status))
+            metrics.count(
+                'emails_sent' if status == OK_STATUS else 'emails_failed')
+            return address, status
+
+        if self.connections == 1 or len(addresses) == 1:
+            return dict(send_to(address) for address in addresses)
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.connections)
+        return dict(self.executor.map(send_to, addresses))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        with self.lock:
+            clients, self.clients = self.clients, []
+        for client in clients:
+            try:
+                client.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+        self.local = threading.local()
@@ -1,23 +1,55 @@
 #!/usr/bin/python3
 import json
 import sys
+from concurrent.futures import (
+    ProcessPoolExecutor, ThreadPoolExecutor, as_completed)
 from datetime import datetime, timedelta
+from functools import lru_cache
+from io import BytesIO
+from operator import attrgetter
 
+import cache
 import dateutil.parser
-import drive
-import emails
-import requests
+import metrics
 import tablib
-from lxml import html
-from terminaltables import AsciiTable
+from core import get_item_configs, get_timestamp, login, now
+from mailer import OK_STATUS, Mailer, render
+from lxml import etree
+from lxml.cssselect import CSSSelector
+from rotacache import RotaCache, content_hash
+from sessioncache import LoginError
+from sheetmodel import cell_ref, diff_cells
+
+# drive (the Google API client), emails and terminaltables are slow to
+# import and only needed for output, so they are imported where used
 
 CA_DATE_FORMAT = '%d-%m-%Y'
 CA_AJAX_DATE_FORMAT = '%Y-%m-%d'
 SHEETS_ROOT_URL = 'https://docs.google.com/spreadsheets/d/'
 LEAD_ROLES = ['leader', 'preacher', ]
 EXCLUDE_ROLES = ['reserve', ]
-
-
+RAJAX_URL = "https://{churchname}.churchsuite.co.uk/ajax/rotas/rajax?date_start={fromdate}&date_end={todate}&order_by=default&break_page_on_week=off&show_empty_dates=off&show_members_table=off&page={page}&submit_btn=Generate&pg=rotas_overview&view=dates"  # noqa
+# Concurrent report requests per run, and a guard against runaway paging
+FETCH_WORKERS = 4
+# Sites fetched at once in multi-site mode (each with FETCH_WORKERS
+# requests in flight; the per-host rate limit still applies)
+SITE_WORKERS = 4
+MAX_PAGES = 50
+# Compiled once - parse_dates runs these for every date, rota and member
+ROTA_DATE_SELECTOR = CSSSelector('div.rota-date', translator='html')
+ROTA_NAME_SELECTOR = CSSSelector('.date-rota-name', translator='html')
+MEMBER_SELECTOR = CSSSelector(
+    'ul.date-members li.profile-initial', translator='html')
+PROFILE_NAME_SELECTOR = CSSSelector('.profile-name', translator='html')
+ROLES_SELECTOR = CSSSelector('.roles', translator='html')
+# Weeks refetched on an incremental run (see fetch_dataset)
+REFRESH_WEEKS = 6
+# (row, column) of the "Last update" cell on the Overview and Next Sunday
+# sheets
+TIMESTAMP_CELL = (0, 1)
+
+
+@lru_cache(maxsize=None)
 def is_leader_role(role):
     role = role.lower()
     for lrole in LEAD_ROLES:
@@ -26,166 +58,394 @@ def is_leader_role(role):
     return False
 
 
-def login(churchname, username, password, siteid=None):
+class Member:
     """
-    Login to churchsuite
+    A person on a rota for one date, with their role classified up front
     """
-    site_switcher_url = 'https://{churchname}.churchsuite.co.uk/ajax/site'
-    login_url = "https://login.churchsuite.com/"
-    print('Logging in via {}'.format(login_url))
-
-    session = requests.Session()
-    login_response = session.post(
-        login_url,
-        data={
-            'username': username,
-            'password': password,
-            'system': 'admin',
-            },
-        cookies={
-            'churchapp_login_account': churchname
+    __slots__ = ('name', 'role', 'is_leader', 'is_excluded')
+
+    def __init__(self, name, role):
+        self.name = name
+        self.role = role
+        self.is_leader = is_leader_role(role)
+        self.is_excluded = role.lower() in EXCLUDE_ROLES
+
+    @property
+    def label(self):
+        if self.role and not self.is_leader:
+            return '{} ({})'.format(self.name, self.role)
+        return self.name
+
+    def to_json(self):
+        return {
+            'name': self.name,
+            'role': self.role,
         }
-    )
-    if login_response.url == login_url:
-        print('Error - login failed!')
-        sys.exit(1)
-    print('Login OK')
-    if siteid is not None:
-        print('Switching site to: {}'.format(siteid))
-        session.put(
-            site_switcher_url.format(churchname=churchname),
-            data={
-                'site_id': siteid,
-            },
-        )
-    return session
 
 
-def fetch_overview(churchname, username, password, year=None, siteid=None):
-    report_url = "https://{churchname}.churchsuite.co.uk/modules/rotas/reports/rotas_overview.php?date_start={fromdate}&date_end={todate}&order_by=default&submit_btn=Generate"  # noqa
-    ajax_report_url = "https://{churchname}.churchsuite.co.uk/ajax/rotas/rajax?date_start={fromdate}&date_end={todate}&order_by=default&break_page_on_week=off&show_empty_dates=off&show_members_table=off&page=1&submit_btn=Generate&pg=rotas_overview&view=dates"  # noqa
+def load_rotas(rotas):
+    """
+    Rebuild Members from JSON rota data (see Member.to_json)
+    """
+    return {
+        team: [Member(member['name'], member['role']) for member in rota]
+        for team, rota in rotas.items()
+    }
 
+
+def get_date_range(year=None, days=365):
     if year is None:
-        now = datetime.now()
-        fromdate = datetime.now()
-        todate = (now + timedelta(days=365))
+        fromdate = now()
+        todate = (fromdate + timedelta(days=days))
     else:
         fromdate = datetime(year, 1, 1)
         todate = datetime(year+1, 1, 1)
+    return fromdate, todate
+
+
+def get_month_chunks(fromdate, todate):
+    """
+    Split fromdate..todate (inclusive) into month-sized ranges
+    """
+    chunks = []
+    start = fromdate
+    while start <= todate:
+        next_month = (
+            start.replace(day=1) + timedelta(days=32)
+        ).replace(day=1)
+        end = min(next_month - timedelta(days=1), todate)
+        chunks.append((start, end))
+        start = next_month
+    return chunks
+
+
+def fetch_report_pages(session, churchname, fromdate, todate):
+    """
+    Fetch every page of the rotas overview report for a date range
+    """
+    pages = []
+    for page in range(1, MAX_PAGES + 1):
+        url = RAJAX_URL.format(
+            churchname=churchname,
+            fromdate=fromdate.strftime(CA_AJAX_DATE_FORMAT),
+            todate=todate.strftime(CA_AJAX_DATE_FORMAT),
+            page=page,
+        )
+        print('Running report: {}'.format(url))
+        response = session.get(url)
+        # Don't mistake an error page for the end of the report
+        response.raise_for_status()
+        text = response.text
+        # An empty page (or the server repeating the last one) means
+        # we've run out of results
+        if 'report_break' not in text or (pages and text == pages[-1]):
+            break
+        pages.append(text)
+    return pages
+
+
+def fetch_overview(churchname, username, password, year=None, siteid=None,
+                   days=365, session=None):
+    """
+    Fetch the rotas overview report as a list of HTML pages, in date order.
+
+    The range is requested in month-sized chunks, fetched concurrently over
+    one logged-in session. An existing session (logged in to siteid) can
+    be passed in.
+    """
+    report_url = "https://{churchname}.churchsuite.co.uk/modules/rotas/reports/rotas_overview.php?date_start={fromdate}&date_end={todate}&order_by=default&submit_btn=Generate"  # noqa
+
+    fromdate, todate = get_date_range(year, days)
 
     print('Fetching rotas from {} to {}'.format(
         fromdate.date(), todate.date()
     ))
 
-    session = login(churchname, username, password, siteid)
+    if session is None:
+        session = login(churchname, username, password, siteid)
+
+    # Timed separately from login, which has its own stage
+    with metrics.timer('fetch'), \
+            ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        chunk_pages = executor.map(
+            lambda chunk: fetch_report_pages(session, churchname, *chunk),
+            get_month_chunks(fromdate, todate),
+        )
+        return [page for pages in chunk_pages for page in pages]
 
-    url = ajax_report_url.format(
-        churchname=churchname,
-        fromdate=fromdate.strftime(CA_AJAX_DATE_FORMAT),
-        todate=todate.strftime(CA_AJAX_DATE_FORMAT),
-    )
-    print('Running report: {}'.format(url))
-    response = session.get(url)
-    return response.text
+
+def has_class(el, classname):
+    return classname in el.get('class', '').split()
 
 
 def grab_text(el, selector):
-    return el.cssselect(selector)[0].text_content()
+    return ''.join(selector(el)[0].itertext())
 
 
-def parse_data(text):
-    print('Parsing...')
-    master = []
-    team_names = []
-    tree = html.fromstring(text)
+def parse_date_block(heading, block):
+    """
+    Read a (date, rotas) record from a report_break heading and the block
+    containing it, or None if the date isn't a Sunday
+    """
+    thedate = dateutil.parser.parse(''.join(heading.itertext()))
+    # We only care about sundays at the moment
+    if thedate.weekday() != 6:
+        return None
+
+    date_rotas = {}
+    for rota in ROTA_DATE_SELECTOR(block):
+        team = grab_text(rota, ROTA_NAME_SELECTOR)
+        date_rotas[team] = sorted(
+            (
+                Member(
+                    grab_text(member, PROFILE_NAME_SELECTOR),
+                    grab_text(member, ROLES_SELECTOR),
+                )
+                for member in MEMBER_SELECTOR(rota)
+            ),
+            key=attrgetter('role'),
+        )
+    return thedate, date_rotas
 
-    # First pass to read data
-    dates = tree.cssselect('.rota-section h2.report_break')
-    if not dates:
-        print('Error: No dates found')
-        return
 
-    for el in dates:
-        date_rotas = {}
-        datetext = el.text_content()
-        thedate = dateutil.parser.parse(datetext)
-        # We only care about sundays at the moment
-        if thedate.weekday() != 6:
-            continue
-
-        rotas = el.getparent().cssselect('div.rota-date')
-        for rota in rotas:
-            team = grab_text(rota, '.date-rota-name')
-            if team not in team_names:
-                team_names.append(team)
-            date_rotas[team] = []
-            members = rota.cssselect('ul.date-members li.profile-initial')
-            for member in members:
-                name = grab_text(member, '.profile-name')
-                role = grab_text(member, '.roles')
-                date_rotas[team].append({
-                    'name': name,
-                    'role': role,
-                    })
-        master.append((thedate, date_rotas))
-
-    # now organise
-    team_names.sort()
+def is_report_break(el):
+    if el.tag != 'h2' or not has_class(el, 'report_break'):
+        return False
+    return any(
+        has_class(ancestor, 'rota-section')
+        for ancestor in el.iterancestors()
+    )
+
+
+def iter_dates(pages):
+    """
+    Yield (date, {team: [member, ...]}) records for each Sunday in a
+    rotas overview report (one HTML page, or a list of pages).
+
+    Pages are parsed incrementally: each date block is read as soon as it
+    is complete and then discarded, so memory use doesn't grow with the
+    size of the report.
+    """
+    if isinstance(pages, str):
+        pages = [pages, ]
+    for text in pages:
+        # Blocks holding a date heading, waiting for their closing tag
+        pending = set()
+        context = etree.iterparse(
+            BytesIO(text.encode('utf-8')),
+            events=('end', ),
+            html=True,
+            encoding='utf-8',
+        )
+        for _, el in context:
+            if is_report_break(el):
+                pending.add(el.getparent())
+                continue
+            if el not in pending:
+                continue
+            pending.discard(el)
+            for heading in el.iterchildren('h2'):
+                if is_report_break(heading):
+                    record = parse_date_block(heading, el)
+                    if record is not None:
+                        yield record
+            el.clear()
+            while el.getprevious() is not None:
+                del el.getparent()[0]
+
+
+def parse_dates(pages):
+    return list(iter_dates(pages))
+
+
+def format_rota(rota):
+    """
+    Names to show for a rota: just the leaders if there are any,
+    otherwise everyone (excluded roles are always dropped)
+    """
+    included = [member for member in rota if member.is_leader]
+    if not included:
+        # No leader match - just use all of them
+        included = rota
+    return ', '.join(
+        member.label for member in included if not member.is_excluded
+    )
+
+
+def build_dataset(master):
+    """
+    Organise parsed (date, rotas) records into a dataset with a column
+    per team
+    """
+    team_names = sorted({team for _, rotas in master for team in rotas})
+    columns = {
+        team: index for index, team in enumerate(team_names, start=1)
+    }
+
     dataset = tablib.Dataset()
     dataset.headers = ['Date', ] + team_names
     for thedate, rotas in master:
-        row = [thedate.date(), ]
-        for team_name in team_names:
-            names = []
-            rota = rotas.get(team_name)
-            if rota:
-                rota.sort(key=lambda x: x['role'])
-                included = []
-                for member in rota:
-                    if is_leader_role(member['role']):
-                        included.append(member)
-                if not included:
-                    # No leader match - just use all of them
-                    included = rota
-                for member in included:
-                    name = member['name']
-                    if member['role'].lower() in EXCLUDE_ROLES:
-                        continue
-                    elif member['role'] and not \
-                            is_leader_role(member['role']):
-                        name += ' ({})'.format(member['role'])
-                    names.append(name)
-            row.append(', '.join(names))
+        row = [thedate.date(), ] + [''] * len(team_names)
+        for team, rota in rotas.items():
+            row[columns[team]] = format_rota(rota)
         dataset.append(row)
 
     return dataset
 
 
-def write_to_sheet(rows, sheetid, range_name, clear=True):
+def parse_data(pages):
+    print('Parsing...')
+    master = parse_dates(pages)
+    if not master:
+        print('Error: No dates found')
+        return
+    return build_dataset(master)
+
+
+def get_rota_cache(config):
+    return RotaCache(cache.get_cache_path('rotas-{}-{}.sqlite'.format(
+        config['churchname'],
+        config.get('site_id') or 'default',
+    )))
+
+
+def fetch_site(config, full=False, session=None):
+    """
+    Fetch report pages for the site in config.
+
+    A full year is fetched when the rota cache has not been fully
+    refreshed recently (or full=True); otherwise only the next few weeks.
+    Returns (pages, fromdate, todate, full).
+    """
+    rota_cache = get_rota_cache(config)
+    try:
+        full = full or rota_cache.needs_full_refresh()
+    finally:
+        rota_cache.close()
+    if full:
+        days = 365
+    else:
+        days = config.get('refresh_weeks', REFRESH_WEEKS) * 7
+    fromdate, todate = get_date_range(days=days)
+    pages = fetch_overview(
+        config['churchname'],
+        config['username'],
+        config['password'],
+        siteid=config.get('site_id', None),
+        days=days,
+        session=session,
+    )
+    return pages, fromdate, todate, full
+
+
+@metrics.timed('parse')
+def merge_site(config, records, fromdate, todate, full):
+    """
+    Merge freshly parsed records for fromdate..todate into the site's rota
+    cache, and organise everything cached from fromdate onwards
+    """
+    rota_cache = get_rota_cache(config)
+    try:
+        changed = rota_cache.merge(records, fromdate.date(), todate.date())
+        print('{} dates changed since last run'.format(changed))
+        if full:
+            rota_cache.mark_full_fetch()
+        rota_cache.prune(fromdate.date())
+        master = [
+            (thedate, load_rotas(rotas))
+            for thedate, rotas in rota_cache.records(fromdate.date())
+        ]
+    finally:
+        rota_cache.close()
+
+    if not master:
+        print('Error: No dates found')
+        return
+    return build_dataset(master)
+
+
+def fetch_dataset(config, full=False, session=None):
+    """
+    Fetch, parse and organise rotas via the local rota cache
+    """
+    pages, fromdate, todate, full = fetch_site(config, full, session)
+    print('Parsing...')
+    return merge_site(config, iter_dates(pages), fromdate, todate, full)
+
+
+def without_cells(rows, cells):
+    """
+    A copy of rows with the given (row, column) cells blanked
+    """
+    rows = [list(row) for row in rows]
+    for row_index, col_index in cells:
+        if row_index < len(rows) and col_index < len(rows[row_index]):
+            rows[row_index][col_index] = ''
+    return rows
+
+
+def write_changes_to_sheet(rows, sheetid, range_name, volatile=()):
+    """
+    Write only the cells that differ from the sheet's current values: one
+    read, plus a single batch update if anything changed.
+
+    Volatile cells (e.g. a "Last update" timestamp) don't count as changes
+    by themselves, but are rewritten along with any other change.
+    """
+    import drive
+    current = drive.read_values(sheetid, range_name)
+    changes = diff_cells(
+        without_cells(current, volatile),
+        without_cells(rows, volatile),
+    )
+    if not changes:
+        print('No changes to {}'.format(range_name))
+        return
+
+    writer = drive.BatchWriter(sheetid)
+    for row_index, col_index in volatile:
+        if row_index < len(rows) and col_index < len(rows[row_index]):
+            writer.update_cell(
+                cell_ref(range_name, row_index + 1, col_index),
+                rows[row_index][col_index],
+            )
+    for row_num, col_index, values in changes:
+        writer.update(
+            cell_ref(range_name, row_num, col_index, len(values)),
+            [values, ],
+        )
+    writer.flush()
+    print('{} changed ranges written to: {}{}'.format(
+        len(changes), SHEETS_ROOT_URL, sheetid))
+
+
+def write_to_sheet(rows, sheetid, range_name, clear=True, diff=False,
+                   volatile=()):
+    if diff:
+        return write_changes_to_sheet(rows, sheetid, range_name, volatile)
+    import drive
     body = {
         'values': rows
     }
     service = drive.get_service()
-    if clear:
-        service.spreadsheets().values().clear(
+    with metrics.timer('sheets_write'):
+        if clear:
+            service.spreadsheets().values().clear(
+                spreadsheetId=sheetid,
+                body={},
+                range=range_name
+            ).execute()
+
+        service.spreadsheets().values().update(
             spreadsheetId=sheetid,
-            body={},
+            body=body,
+            valueInputOption='USER_ENTERED',
             range=range_name
         ).execute()
-
-    service.spreadsheets().values().update(
-        spreadsheetId=sheetid,
-        body=body,
-        valueInputOption='USER_ENTERED',
-        range=range_name
-    ).execute()
     print('Changes written to: {}{}'.format(SHEETS_ROOT_URL, sheetid))
 
 
-def write_overview(dataset, sheetid):
-    # Overview
-    print('Updating Overview Sheet...')
-    timestamp = get_timestamp()
+def overview_rows(dataset, timestamp):
     values = [
         ['', "Last update: {}".format(timestamp), ],
         dataset.headers,
@@ -194,20 +454,29 @@ def write_overview(dataset, sheetid):
     for row in dataset:
         cols = [str(x) for x in row]
         values.append(cols)
+    return values
 
-    write_to_sheet(values, sheetid, "Overview")
+
+def write_overview(dataset, sheetid, diff=False):
+    # Overview
+    print('Updating Overview Sheet...')
+    values = overview_rows(dataset, get_timestamp())
+    write_to_sheet(values, sheetid, "Overview", diff=diff,
+                   volatile=[TIMESTAMP_CELL])
 
 
 def display_rows(rows):
+    from terminaltables import AsciiTable
     table = AsciiTable(rows)
     print(table.table)
 
 
-def write_next(dataset, sheetid, churchname,
-               site_name, notify=None, smtp=None):
-    # Next sunday
-    print('Updating Next Sunday Sheet...')
-    timestamp = get_timestamp()
+def next_sunday_rows(dataset, timestamp):
+    """
+    Rows for the first (next) Sunday in the dataset.
+
+    Returns (nicedate, header_rows, rows).
+    """
     sunday = dataset.dict[0]
     nicedate = sunday['Date'].strftime('%A %d %b %Y').replace(" 0", " ")
     header_rows = [
@@ -219,16 +488,14 @@ def write_next(dataset, sheetid, churchname,
         value = str(sunday[header])
         if value:
             rows.append((header, value))
+    return nicedate, header_rows, rows
 
-    write_to_sheet(header_rows + rows, sheetid, "Next Sunday")
-    display_rows(header_rows + rows)
 
-    # Emails
-    if notify and smtp:
-        next_dataset = tablib.Dataset(
-            *rows,
-            headers=('Rota', 'People'))
-        html = """<style>th, td {{ border-bottom: 1px solid #ccc; padding: 3px; }}</style>
+def render_next_html(rows, nicedate, churchname, sheetid):
+    next_dataset = tablib.Dataset(
+        *rows,
+        headers=('Rota', 'People'))
+    return """<style>th, td {{ border-bottom: 1px solid #ccc; padding: 3px; }}</style>
 <p><em>This is an automated email generated from all rotas on <a href="{churchsuiteurl}">{churchsuiteurl}</a></em></p>
 <p>
 <b>{nicedate}</b>
@@ -256,31 +523,187 @@ Please note:
            sheeturl=SHEETS_ROOT_URL + sheetid,
            nicedate=nicedate,
            excluded=', '.join(EXCLUDE_ROLES))
-        message = emails.html(
-            html=html,
-            subject='[{}] Sunday Roles {}'.format(site_name, nicedate),
-            mail_from=smtp.get('user'),
-            headers={
-                'X-Mailer': 'ChurchSuite Master Rota',
-                'X-Auto-Response-Suppress': (
-                    'DR, NDR, RN, NRN, OOF, AutoReply'),
-            })
-        for address in notify:
-            response = message.send(
-                to=address,
-                smtp={
-                    "host": smtp.get('host'),
-                    "ssl": smtp.get('ssl', False),
-                    "port": smtp.get('port', 25),
-                    "user": smtp.get('user', None),
-                    "password": smtp.get('password', None),
-                    }
-            )
-            print('Notifying {} ({})'.format(address, response.status_code))
 
 
-def get_timestamp():
-    return datetime.now().strftime('%Y-%m-%d %H:%M')
+def write_next(dataset, sheetid, churchname,
+               site_name, notify=None, smtp=None, mailer=None,
+               skip_unchanged=False, diff=False):
+    # Next sunday
+    print('Updating Next Sunday Sheet...')
+    nicedate, header_rows, rows = next_sunday_rows(dataset, get_timestamp())
+
+    write_to_sheet(header_rows + rows, sheetid, "Next Sunday", diff=diff,
+                   volatile=[TIMESTAMP_CELL])
+    display_rows(header_rows + rows)
+
+    # Emails
+    if notify and smtp:
+        send_next_email(rows, nicedate, sheetid, churchname, site_name,
+                        notify, smtp, mailer, skip_unchanged)
+
+
+def render_next_email(rows, nicedate, sheetid, churchname, site_name, smtp):
+    import emails
+    html = render_next_html(rows, nicedate, churchname, sheetid)
+    message = emails.html(
+        html=html,
+        subject='[{}] Sunday Roles {}'.format(site_name, nicedate),
+        mail_from=smtp.get('user'),
+        headers={
+            'X-Mailer': 'ChurchSuite Master Rota',
+            'X-Auto-Response-Suppress': (
+                'DR, NDR, RN, NRN, OOF, AutoReply'),
+        })
+    return render(message)
+
+
+@metrics.timed('notify')
+def send_next_email(rows, nicedate, sheetid, churchname, site_name,
+                    notify, smtp, mailer=None, skip_unchanged=False):
+    """
+    Send the Next Sunday email.
+
+    The rendered MIME body is cached against a hash of its content, sender
+    and recipients, so it is only rebuilt when one of those changes. With
+    skip_unchanged, an email that has already been sent is not sent again.
+    """
+    digest = content_hash(json.dumps([
+        churchname,
+        site_name,
+        sheetid,
+        nicedate,
+        rows,
+        notify,
+        smtp.get('user'),
+    ]))
+    state_file = 'next-sunday-{}.json'.format(sheetid)
+    state = cache.load_json(state_file, {})
+    if state.get('hash') != digest:
+        state = {
+            'hash': digest,
+            'body': render_next_email(
+                rows, nicedate, sheetid, churchname, site_name, smtp),
+            'sent': False,
+        }
+        cache.save_json(state_file, state)
+    elif state['sent'] and skip_unchanged:
+        print('Next Sunday unchanged since the last email - not sending')
+        return
+
+    if mailer is None:
+        with Mailer(smtp) as mailer:
+            statuses = mailer.send_rendered(state['body'], notify)
+    else:
+        statuses = mailer.send_rendered(state['body'], notify)
+    if OK_STATUS in statuses.values():
+        state['sent'] = True
+        cache.save_json(state_file, state)
+
+
+def publish(config, dataset, notify=False, mailer=None):
+    """
+    Write a site's dataset to its sheets (and notify, if asked).
+    Returns False if there was nothing to publish.
+    """
+    if not (dataset and len(dataset)):
+        print('Error: no data was parsed!!')
+        return False
+
+    diff = config.get('diff_sheets', False)
+    write_overview(dataset, config['google_sheet_id'], diff=diff)
+    write_next(
+        dataset,
+        config['google_sheet_id'],
+        config['churchname'],
+        config['site_name'],
+        notify=notify and config.get('notify'),
+        smtp=config.get('smtp'),
+        mailer=mailer,
+        skip_unchanged=config.get('skip_unchanged_notify', False),
+        diff=diff,
+    )
+    return True
+
+
+def publish_site(config, parsed, fromdate, todate, full, notify, mailer):
+    dataset = merge_site(config, parsed.result(), fromdate, todate, full)
+    return publish(config, dataset, notify, mailer)
+
+
+def run_sites(config, notify=False, full=False):
+    """
+    Update every site in a multi-site config.
+
+    Sites are fetched concurrently (up to SITE_WORKERS at a time), each
+    over its own cached login. As each site's pages arrive they are parsed
+    in a process pool and published from a thread pool, overlapping with
+    the fetches still running.
+    """
+    sites = get_item_configs(config, 'sites')
+    if not sites:
+        print('Error: no sites configured')
+        return False
+    mailer = None
+    if notify and config.get('smtp'):
+        # Shared by every site that has the shared smtp settings
+        mailer = Mailer(config['smtp'])
+    ok = True
+    try:
+        with ThreadPoolExecutor(
+                max_workers=min(SITE_WORKERS, len(sites))) as fetch_pool, \
+                ProcessPoolExecutor() as parse_pool, \
+                ThreadPoolExecutor(max_workers=len(sites)) as publish_pool:
+            fetches = {
+                fetch_pool.submit(fetch_site, site, full): site
+                for site in sites
+            }
+            published = []
+            for fetch in as_completed(fetches):
+                site = fetches[fetch]
+                print('Fetched site: {}'.format(site['site_name']))
+                try:
+                    pages, fromdate, todate, site_full = fetch.result()
+                except Exception as e:
+                    # Carry on with the other sites
+                    print('Error fetching {}: {!r}'.format(
+                        site['site_name'], e))
+                    ok = False
+                    continue
+                parsed = parse_pool.submit(parse_dates, pages)
+                published.append((site, publish_pool.submit(
+                    publish_site,
+                    site, parsed, fromdate, todate, site_full, notify,
+                    mailer if site.get('smtp') == config.get('smtp')
+                    else None,
+                )))
+
+            for site, future in published:
+                try:
+                    if not future.result():
+                        ok = False
+                except Exception as e:
+                    print('Error updating {}: {!r}'.format(
+                        site['site_name'], e))
+                    ok = False
+    finally:
+        if mailer is not None:
+            mailer.close()
+    return ok
+
+
+def run_config(config, notify=False, full=False, test=False):
+    """
+    Update the sheets for a config (single or multi-site).
+    Returns False if anything failed.
+    """
+    if 'sites' in config:
+        return run_sites(config, notify=notify, full=full)
+    if test:
+        overview = open('example.html').read()
+        dataset = parse_data(overview)
+    else:
+        dataset = fetch_dataset(config, full=full)
+    return publish(config, dataset, notify)
 
 
 if __name__ == "__main__":
@@ -293,30 +716,16 @@ if __name__ == "__main__":
         notify = True
     else:
         notify = False
+    full = '--full' in sys.argv
 
     with open(configfile, 'r') as f:
         config = json.load(f)
-    if '--test' in sys.argv:
-        overview = open('example.html').read()
-    else:
-        overview = fetch_overview(
-            config['churchname'],
-            config['username'],
-            config['password'],
-            siteid=config.get('site_id', None),
-        )
-    dataset = parse_data(overview)
-    if not (dataset and len(dataset)):
-        print('Error: no data was parsed!!')
+    try:
+        ok = run_config(config, notify, full, '--test' in sys.argv)
+    except LoginError as e:
+        print('Error - {}'.format(e))
+        sys.exit(1)
+    metrics.write_report(config, 'masterrota')
+    if not ok:
         sys.exit(1)
-
-    write_overview(dataset, config['google_sheet_id'])
-    write_next(
-        dataset,
-        config['google_sheet_id'],
-        config['churchname'],
-        config['site_name'],
-        notify=notify and config.get('notify'),
-        smtp=config.get('smtp'),
-    )
     print('Done')
@@ -0,0 +1,153 @@
+"""
+Per-run timings and counters.
+
+Stages are timed with `with metrics.timer('fetch'):` (or the @timed
+decorator) and events counted with metrics.count('http_requests'). Both
+are safe to use from worker threads. At the end of a run, write_report
+appends a JSON record to metrics_file and/or writes a Prometheus textfile
+to metrics_textfile, if either is set in the config.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+PROMETHEUS_PREFIX = 'churchsuite'
+
+_lock = threading.Lock()
+_started = time.time()
+_stages = {}
+_counters = {}
+
+
+def reset():
+    global _started
+    with _lock:
+        _started = time.time()
+        _stages.clear()
+        _counters.clear()
+
+
+def count(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def record(stage, seconds):
+    with _lock:
+        timing = _stages.setdefault(stage, {
+            'count': 0,
+            'seconds': 0.0,
+            'max_seconds': 0.0,
+        })
+        timing['count'] += 1
+        timing['seconds'] += seconds
+        timing['max_seconds'] = max(timing['max_seconds'], seconds)
+
+
+@contextmanager
+def timer(stage):
+    """
+    Time the enclosed block as (one call of) stage. Stages that run
+    several times, or in several threads, add up.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - started)
+
+
+def timed(stage):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_response(response, *args, **kwargs):
+    """
+    requests response hook: count requests and bytes received
+    """
+    count('http_requests')
+    count('http_bytes', len(response.content or b''))
+    if response.status_code >= 400:
+        count('http_errors')
+
+
+def snapshot(job=None):
+    with _lock:
+        return {
+            'job': job,
+            'started': _started,
+            'seconds': round(time.time() - _started, 6),
+            'stages': {
+                stage: {
+                    'count': timing['count'],
+                    'seconds': round(timing['seconds'], 6),
+                    'max_seconds': round(timing['max_seconds'], 6),
+                }
+                for stage, timing in _stages.items()
+            },
+            'counters': dict(_counters),
+        }
+
+
+def format_prometheus(report):
+    """
+    Prometheus text exposition format, for the node_exporter textfile
+    collector
+    """
+    labels = 'job="{}"'.format(report['job'] or '')
+    lines = [
+        '# TYPE {}_run_timestamp_seconds gauge'.format(PROMETHEUS_PREFIX),
+        '{}_run_timestamp_seconds{{{}}} {}'.format(
+            PROMETHEUS_PREFIX, labels, report['started']),
+        '# TYPE {}_run_seconds gauge'.format(PROMETHEUS_PREFIX),
+        '{}_run_seconds{{{}}} {}'.format(
+            PROMETHEUS_PREFIX, labels, report['seconds']),
+        '# TYPE {}_stage_seconds gauge'.format(PROMETHEUS_PREFIX),
+    ]
+    for stage, timing in sorted(report['stages'].items()):
+        lines.append('{}_stage_seconds{{{},stage="{}"}} {}'.format(
+            PROMETHEUS_PREFIX, labels, stage, timing['seconds']))
+    for name, value in sorted(report['counters'].items()):
+        lines.append('# TYPE {}_{} gauge'.format(PROMETHEUS_PREFIX, name))
+        lines.append('{}_{}{{{}}} {}'.format(
+            PROMETHEUS_PREFIX, name, labels, value))
+    return '\n'.join(lines) + '\n'
+
+
+def write_report(config, job):
+    """
+    Print a summary of this run, and save it where the config asks:
+    metrics_file (JSON, one line per run) and metrics_textfile
+    (Prometheus). Either path may include {job}.
+    """
+    report = snapshot(job)
+    print('Timings: {}'.format(', '.join(
+        '{} {:.2f}s'.format(stage, timing['seconds'])
+        for stage, timing in report['stages'].items()
+    ) or 'none'))
+    if report['counters']:
+        print('Counts: {}'.format(', '.join(
+            '{} {}'.format(name, value)
+            for name, value in sorted(report['counters'].items())
+        )))
+
+    if config.get('metrics_file'):
+        with open(config['metrics_file'].format(job=job), 'a') as f:
+            f.write(json.dumps(report, sort_keys=True) + '\n')
+    if config.get('metrics_textfile'):
+        path = config['metrics_textfile'].format(job=job)
+        # Written atomically, as the collector may read it at any time
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(format_prometheus(report))
+        os.replace(tmp_path, path)
+    return report
@@ -0,0 +1,426 @@
+#!/usr/bin/python3
+"""
+Record and replay fixtures, for running the tools without network access.
+
+Set CHURCHSUITE_FIXTURES to a directory, and CHURCHSUITE_FIXTURE_MODE to:
+
+- record: ChurchSuite HTTP responses are saved to the directory as they
+  are fetched (Sheets and SMTP are still live)
+- replay: ChurchSuite responses come from the directory, Google Sheets is
+  replaced by an in-memory stand-in seeded from (and saved back to) the
+  directory, and emails are written to its outbox/ instead of being sent
+
+Sheets contents (and the API discovery document the stand-in needs) are
+captured with:
+
+    python replay.py <fixtures-dir> snapshot <google-sheet-id>
+"""
+import base64
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+from datetime import datetime
+from urllib.parse import parse_qs, unquote, urlparse
+
+FIXTURES_VAR = 'CHURCHSUITE_FIXTURES'
+MODE_VAR = 'CHURCHSUITE_FIXTURE_MODE'
+RECORD = 'record'
+REPLAY = 'replay'
+CLOCK_FILE = 'clock.json'
+DISCOVERY_FILE = 'sheets-v4-discovery.json'
+CLOCK_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# Not worth keeping (or leaking) in fixtures
+SKIPPED_HEADERS = ('set-cookie', 'content-encoding', 'transfer-encoding')
+
+_lock = threading.Lock()
+_clock_saved = False
+
+
+def get_mode():
+    mode = os.environ.get(MODE_VAR)
+    if mode and mode not in (RECORD, REPLAY):
+        raise ValueError('{} must be {} or {}'.format(
+            MODE_VAR, RECORD, REPLAY))
+    return mode
+
+
+def replaying():
+    return get_mode() == REPLAY
+
+
+def get_path(*parts):
+    path = os.path.join(os.environ.get(FIXTURES_VAR, 'fixtures'), *parts)
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    return path
+
+
+def clock():
+    """
+    When replaying, the time the fixtures were recorded (so date ranges
+    and 'last Sunday' match the recorded requests), otherwise None
+    """
+    if not replaying():
+        return None
+    try:
+        with open(get_path(CLOCK_FILE), 'r') as f:
+            return datetime.strptime(json.load(f)['now'], CLOCK_FORMAT)
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_clock():
+    global _clock_saved
+    with _lock:
+        if _clock_saved:
+            return
+        with open(get_path(CLOCK_FILE), 'w') as f:
+            json.dump({'now': datetime.now().strftime(CLOCK_FORMAT)}, f)
+        _clock_saved = True
+
+
+# ChurchSuite (requests)
+
+def request_key(method, url, body):
+    """
+    Fixture file for a request: method, URL and body, hashed (so the login
+    password isn't stored in the clear)
+    """
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    digest = hashlib.sha1(
+        '{} {}\n'.format(method, url).encode('utf-8') + (body or b''))
+    return get_path('http', '{}.json'.format(digest.hexdigest()))
+
+
+def save_response(request, response):
+    content = response.content
+    try:
+        body = {'text': content.decode('utf-8')}
+    except UnicodeDecodeError:
+        body = {'base64': base64.b64encode(content).decode('ascii')}
+    fixture = dict(body, **{
+        'method': request.method,
+        'url': request.url,
+        'final_url': response.url,
+        'status': response.status_code,
+        'reason': response.reason,
+        'headers': {
+            name: value for name, value in response.headers.items()
+            if name.lower() not in SKIPPED_HEADERS
+        },
+    })
+    with open(request_key(request.method, request.url, request.body),
+              'w') as f:
+        json.dump(fixture, f, indent=1)
+    save_clock()
+
+
+def load_response(request):
+    import requests
+    from requests.structures import CaseInsensitiveDict
+    from requests.utils import get_encoding_from_headers
+
+    path = request_key(request.method, request.url, request.body)
+    try:
+        with open(path, 'r') as f:
+            fixture = json.load(f)
+    except OSError:
+        raise requests.ConnectionError(
+            'No recorded response for {} {}'.format(
+                request.method, request.url),
+            request=request,
+        )
+    response = requests.Response()
+    response.status_code = fixture['status']
+    response.reason = fixture['reason']
+    response.headers = CaseInsensitiveDict(fixture['headers'])
+    response.encoding = get_encoding_from_headers(response.headers)
+    response.url = fixture['final_url']
+    response.request = request
+    if 'base64' in fixture:
+        response._content = base64.b64decode(fixture['base64'])
+    else:
+        response._content = fixture['text'].encode('utf-8')
+    response._content_consumed = True
+    return response
+
+
+def adapter(live_adapter):
+    """
+    The transport adapter for httpclient.Session: live_adapter itself,
+    or a recording or replaying adapter depending on the fixture mode
+    """
+    from requests.adapters import BaseAdapter
+
+    class RecordingAdapter(BaseAdapter):
+        def send(self, request, **kwargs):
+            response = live_adapter.send(request, **kwargs)
+            save_response(request, response)
+            return response
+
+        def close(self):
+            live_adapter.close()
+
+    class ReplayAdapter(BaseAdapter):
+        def send(self, request, **kwargs):
+            return load_response(request)
+
+        def close(self):
+            pass
+
+    mode = get_mode()
+    if mode == RECORD:
+        return RecordingAdapter()
+    if mode == REPLAY:
+        return ReplayAdapter()
+    return live_adapter
+
+
+# Google Sheets
+
+# 'Sheet name'!A1:B2, with any of the cell parts left out
+RANGE_PATTERN = re.compile(
+    r"^(?:'((?:[^']|'')+)'|([^!]+))"
+    r"(?:!([A-Z]+)?(\d+)?(?::([A-Z]+)?(\d+)?)?)?$"
+)
+
+
+def column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+def parse_range(range_name):
+    """
+    (sheet name, first row, first column, last row, last column) for an A1
+    range; rows and columns from 0, with None for an open end
+    """
+    match = RANGE_PATTERN.match(range_name)
+    if match is None:
+        raise ValueError('Unsupported range: {}'.format(range_name))
+    quoted, plain, col1, row1, col2, row2 = match.groups()
+    sheet_name = quoted.replace("''", "'") if quoted else plain
+    first_row = int(row1) - 1 if row1 else 0
+    first_col = column_index(col1) if col1 else 0
+    if col2 or row2:
+        last_row = int(row2) - 1 if row2 else None
+        last_col = column_index(col2) if col2 else None
+    elif col1 and row1:
+        # A single cell
+        last_row, last_col = first_row, first_col
+    else:
+        last_row = last_col = None
+    return sheet_name, first_row, first_col, last_row, last_col
+
+
+class FakeSpreadsheet:
+    """
+    An in-memory spreadsheet: {sheet name: rows of string values}
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, 'r') as f:
+                self.sheets = json.load(f)
+        except OSError:
+            self.sheets = {}
+
+    def save(self):
+        with open(self.path, 'w') as f:
+            json.dump(self.sheets, f, indent=1)
+
+    def get(self, range_name):
+        sheet_name, row1, col1, row2, col2 = parse_range(range_name)
+        rows = self.sheets.get(sheet_name, [])
+        values = []
+        for row in rows[row1:None if row2 is None else row2 + 1]:
+            values.append(row[col1:None if col2 is None else col2 + 1])
+        # Like the API, trailing blank cells and rows are left out
+        values = [self.trim(row) for row in values]
+        while values and not values[-1]:
+            values.pop()
+        return {'range': range_name, 'values': values}
+
+    def trim(self, row):
+        row = list(row)
+        while row and row[-1] == '':
+            row.pop()
+        return row
+
+    def update(self, range_name, values):
+        sheet_name, row1, col1, _, _ = parse_range(range_name)
+        rows = self.sheets.setdefault(sheet_name, [])
+        for row_offset, new_row in enumerate(values):
+            row_index = row1 + row_offset
+            while len(rows) <= row_index:
+                rows.append([])
+            row = rows[row_index]
+            for col_offset, value in enumerate(new_row):
+                col_index = col1 + col_offset
+                while len(row) <= col_index:
+                    row.append('')
+                row[col_index] = '' if value is None else str(value)
+        return {'updatedRange': range_name}
+
+    def clear(self, range_name):
+        sheet_name, row1, col1, row2, col2 = parse_range(range_name)
+        rows = self.sheets.get(sheet_name, [])
+        for row in rows[row1:None if row2 is None else row2 + 1]:
+            for col_index in range(
+                    col1, len(row) if col2 is None else min(col2 + 1,
+                                                            len(row))):
+                row[col_index] = ''
+        return {'clearedRange': range_name}
+
+
+class FakeSheetsHttp:
+    """
+    Stand-in for the httplib2.Http behind the Sheets service. Handles the
+    values get/batchGet/update/batchUpdate/clear/batchClear calls against
+    FakeSpreadsheets saved under the fixtures directory.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spreadsheets = {}
+
+    def get_spreadsheet(self, sheetid):
+        if sheetid not in self.spreadsheets:
+            self.spreadsheets[sheetid] = FakeSpreadsheet(
+                get_path('sheets', '{}.json'.format(sheetid)))
+        return self.spreadsheets[sheetid]
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        import httplib2
+
+        parsed = urlparse(uri)
+        query = parse_qs(parsed.query)
+        body = json.loads(body) if body else {}
+        match = re.match(r'^/v4/spreadsheets/([^/]+)/values(.*)$',
+                         parsed.path)
+        if match is None:
+            return self.response(httplib2, 404, {'error': uri})
+        sheetid, call = match.groups()
+        with self.lock:
+            spreadsheet = self.get_spreadsheet(sheetid)
+            if call == ':batchGet':
+                result = {
+                    'spreadsheetId': sheetid,
+                    'valueRanges': [
+                        spreadsheet.get(range_name)
+                        for range_name in query.get('ranges', [])
+                    ],
+                }
+            elif call == ':batchClear':
+                result = {'clearedRanges': [
+                    spreadsheet.clear(range_name)['clearedRange']
+                    for range_name in body['ranges']
+                ]}
+            elif call == ':batchUpdate':
+                result = {'responses': [
+                    spreadsheet.update(data['range'], data['values'])
+                    for data in body['data']
+                ]}
+            elif call.endswith(':clear'):
+                result = spreadsheet.clear(unquote(call[1:-len(':clear')]))
+            elif method == 'PUT':
+                result = spreadsheet.update(
+                    unquote(call[1:]), body.get('values', []))
+            else:
+                result = spreadsheet.get(unquote(call[1:]))
+            if method != 'GET':
+                spreadsheet.save()
+        return self.response(httplib2, 200, result)
+
+    def response(self, httplib2, status, data):
+        return (
+            httplib2.Response({
+                'status': str(status),
+                'content-type': 'application/json; charset=UTF-8',
+            }),
+            json.dumps(data).encode('utf-8'),
+        )
+
+
+def load_discovery_document():
+    with open(get_path(DISCOVERY_FILE), 'r') as f:
+        return f.read()
+
+
+def snapshot_sheet(sheetid):
+    """
+    Save every sheet in a live spreadsheet (and the Sheets discovery
+    document) as replay fixtures
+    """
+    import cache
+    import drive
+    service = drive.get_service()
+    metadata = service.spreadsheets().get(
+        spreadsheetId=sheetid,
+        fields='sheets.properties.title',
+    ).execute()
+    titles = [sheet['properties']['title'] for sheet in metadata['sheets']]
+    spreadsheet = FakeSpreadsheet(
+        get_path('sheets', '{}.json'.format(sheetid)))
+    ranges = ["'{}'".format(title.replace("'", "''")) for title in titles]
+    values = drive.read_ranges(sheetid, ranges)
+    spreadsheet.sheets = {
+        title: values[range_name]
+        for title, range_name in zip(titles, ranges)
+    }
+    spreadsheet.save()
+    with open(cache.get_cache_path(drive.DISCOVERY_CACHE_FILE), 'r') as f:
+        document = f.read()
+    with open(get_path(DISCOVERY_FILE), 'w') as f:
+        f.write(document)
+    print('Saved {} sheets to {}'.format(len(titles), spreadsheet.path))
+
+
+# SMTP
+
+class OutboxSMTP:
+    """
+    Stand-in for smtplib.SMTP that writes each message to the fixtures
+    outbox/ directory
+    """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def login(self, user, password):
+        pass
+
+    def sendmail(self, mail_from, addresses, body):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        with _lock:
+            outbox = os.path.dirname(get_path('outbox', 'x'))
+            number = len(os.listdir(outbox)) + 1
+            path = os.path.join(outbox, '{:04d}-{}.eml'.format(
+                number, re.sub(r'[^\w@.-]', '_', ','.join(addresses))))
+            with open(path, 'wb') as f:
+                f.write(body)
+        print('Wrote email to {}'.format(path))
+        return {}
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[2] != 'snapshot':
+        print(__doc__.strip().split('\n\n')[-1].strip())
+        sys.exit(1)
+    os.environ[FIXTURES_VAR] = sys.argv[1]
+    snapshot_sheet(sys.argv[3])
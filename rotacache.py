@@ -0,0 +1,122 @@
+import hashlib
+import json
+import sqlite3
+from datetime import datetime
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+FULL_REFRESH_MAX_AGE = 7 * 24 * 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rota_dates (
+    date TEXT PRIMARY KEY,
+    hash TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def to_json(obj):
+    """
+    JSON fallback for rota members (anything with a to_json method)
+    """
+    return obj.to_json()
+
+
+def dump_rotas(rotas):
+    return json.dumps(rotas, sort_keys=True, default=to_json)
+
+
+def content_hash(data):
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class RotaCache:
+    """
+    Local store of parsed rota data, one record per date.
+
+    Records are keyed by date and carry a hash of their content, so merging
+    a freshly fetched window only rewrites the dates that actually changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def needs_full_refresh(self, max_age=FULL_REFRESH_MAX_AGE):
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'last_full_fetch'"
+        ).fetchone()
+        if row is None:
+            return True
+        last_full_fetch = datetime.strptime(row[0], TIMESTAMP_FORMAT)
+        return (datetime.now() - last_full_fetch).total_seconds() > max_age
+
+    def mark_full_fetch(self):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) "
+                "VALUES ('last_full_fetch', ?)",
+                (datetime.now().strftime(TIMESTAMP_FORMAT), ),
+            )
+
+    def merge(self, records, fromdate, todate):
+        """
+        Merge freshly parsed (date, rotas) records for the window
+        fromdate..todate into the cache.
+
+        Cached dates inside the window that are missing from the fresh data
+        are removed. Returns the number of dates added, changed or removed.
+        """
+        existing = dict(self.db.execute(
+            "SELECT date, hash FROM rota_dates WHERE date BETWEEN ? AND ?",
+            (fromdate.isoformat(), todate.isoformat()),
+        ))
+        changed = 0
+        with self.db:
+            for thedate, rotas in records:
+                key = thedate.date().isoformat()
+                data = dump_rotas(rotas)
+                digest = content_hash(data)
+                if existing.pop(key, None) == digest:
+                    continue
+                self.db.execute(
+                    "INSERT OR REPLACE INTO rota_dates (date, hash, data) "
+                    "VALUES (?, ?, ?)",
+                    (key, digest, data),
+                )
+                changed += 1
+            for key in existing:
+                self.db.execute(
+                    "DELETE FROM rota_dates WHERE date = ?", (key, ))
+                changed += 1
+        return changed
+
+    def prune(self, before):
+        with self.db:
+            self.db.execute(
+                "DELETE FROM rota_dates WHERE date < ?",
+                (before.isoformat(), ),
+            )
+
+    def records(self, fromdate=None):
+        """
+        Cached (date, rotas) records in date order
+        """
+        query = "SELECT date, data FROM rota_dates"
+        params = ()
+        if fromdate is not None:
+            query += " WHERE date >= ?"
+            params = (fromdate.isoformat(), )
+        query += " ORDER BY date"
+        return [
+            (datetime.strptime(key, '%Y-%m-%d'), json.loads(data))
+            for key, data in self.db.execute(query, params)
+        ]
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+"""
+Run masterrota, sundayreview and tagalert jobs on fixed intervals from one
+long-running process.
+
+Imports, ChurchSuite sessions, HTTP connection pools, the Sheets service
+and parse caches all stay in memory between runs, so each run only pays
+for its network work. A failing job is logged and retried at its next
+interval; it doesn't stop the others.
+
+    python scheduler.py <scheduler-config> [--once]
+"""
+import json
+import os
+import sys
+import time
+import traceback
+from datetime import datetime
+
+import metrics
+
+
+def run_masterrota(config, options):
+    import masterrota
+    return masterrota.run_config(
+        config,
+        notify=options.get('notify', False),
+        full=options.get('full', False),
+    )
+
+
+def run_sundayreview(config, options):
+    import sundayreview
+    sundayreview.review(config, sundayreview.get_last_sunday())
+
+
+def run_tagalert(config, options):
+    import tagalert
+    return tagalert.run_config(config)
+
+
+JOBS = {
+    'masterrota': run_masterrota,
+    'sundayreview': run_sundayreview,
+    'tagalert': run_tagalert,
+}
+
+
+def log(message):
+    print('[{}] {}'.format(
+        datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        message,
+    ))
+    sys.stdout.flush()
+
+
+class Job:
+
+    def __init__(self, spec, basedir):
+        self.name = spec.get('name') or spec['job']
+        if spec['job'] not in JOBS:
+            raise ValueError('Unknown job type: {}'.format(spec['job']))
+        self.func = JOBS[spec['job']]
+        self.config_path = os.path.join(basedir, spec['config'])
+        self.interval = spec['interval']
+        self.options = spec.get('options', {})
+        # Due straight away, unless the first run is delayed
+        self.due = time.monotonic() + spec.get('delay', 0)
+
+    def load_config(self):
+        # Read on every run, so config edits don't need a restart
+        with open(self.config_path, 'r') as f:
+            return json.load(f)
+
+    def run(self):
+        """
+        Run the job once, returning True if it succeeded. Errors (including
+        sys.exit calls from the scripts) are logged, not raised.
+        """
+        log('Starting {}'.format(self.name))
+        started = time.monotonic()
+        metrics.reset()
+        try:
+            config = self.load_config()
+            ok = self.func(config, self.options) is not False
+            metrics.write_report(config, self.name)
+        except (Exception, SystemExit):
+            traceback.print_exc()
+            ok = False
+        log('{} {} in {:.1f}s'.format(
+            self.name,
+            'finished' if ok else 'FAILED',
+            time.monotonic() - started,
+        ))
+        # Skip any runs missed while this one was running
+        self.due = max(self.due + self.interval, time.monotonic())
+        return ok
+
+
+def load_jobs(path):
+    with open(path, 'r') as f:
+        config = json.load(f)
+    basedir = os.path.dirname(os.path.abspath(path))
+    return [Job(spec, basedir) for spec in config['jobs']]
+
+
+def run_forever(jobs):
+    while True:
+        job = min(jobs, key=lambda job: job.due)
+        wait = job.due - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        job.run()
+
+
+def run_once(jobs):
+    return all([job.run() for job in jobs])
+
+
+if __name__ == "__main__":
+    try:
+        configfile = sys.argv[1]
+    except IndexError:
+        print('Please provide a JSON config file')
+        sys.exit(1)
+
+    jobs = load_jobs(configfile)
+    if '--once' in sys.argv:
+        if not run_once(jobs):
+            sys.exit(1)
+    else:
+        try:
+            run_forever(jobs)
+        except KeyboardInterrupt:
+            log('Stopped')
@@ -0,0 +1,182 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import cache
+import httpclient
+from requests.cookies import create_cookie
+
+LOGIN_URL = "https://login.churchsuite.com/"
+SITE_SWITCHER_URL = 'https://{churchname}.churchsuite.co.uk/ajax/site'
+# Upper bound on reusing a cached login, for cookies without an expiry
+SESSION_MAX_AGE = 12 * 60 * 60
+
+
+class LoginError(Exception):
+    pass
+
+
+def get_session_path(churchname, username, siteid=None):
+    """
+    The current site is part of the server-side session, so each site gets
+    its own login: runs for different sites never share (and switch) one
+    session
+    """
+    user_hash = hashlib.sha1(username.encode('utf-8')).hexdigest()[:12]
+    return cache.get_cache_path('session-{}-{}-{}.json'.format(
+        churchname,
+        user_hash,
+        siteid or 'default',
+    ))
+
+
+@contextmanager
+def locked(path):
+    """
+    Hold an exclusive lock on path (via a sidecar .lock file), so
+    concurrent runs don't read a half-written session
+    """
+    with open(path + '.lock', 'w') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def load_state(path):
+    """
+    Cached login state, or None if missing, unreadable or expired
+    """
+    with locked(path):
+        try:
+            with open(path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+    if time.time() - state['saved'] > SESSION_MAX_AGE:
+        return None
+    cookies = [create_cookie(**cookie) for cookie in state['cookies']]
+    if any(cookie.is_expired() for cookie in cookies):
+        return None
+    state['cookies'] = cookies
+    return state
+
+
+def save_state(path, cookies, site_id):
+    state = {
+        'saved': time.time(),
+        'cookies': [
+            {
+                'name': cookie.name,
+                'value': cookie.value,
+                'domain': cookie.domain,
+                'path': cookie.path,
+                'expires': cookie.expires,
+                'secure': cookie.secure,
+            }
+            for cookie in cookies
+        ],
+        'site_id': site_id,
+    }
+    with locked(path):
+        # Created owner-only, so the cookies are never readable by others
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+
+
+class ChurchSuiteSession(httpclient.Session):
+    """
+    A logged-in ChurchSuite session for one site, persisted between runs.
+
+    Cookies from the last login are reused until ChurchSuite rejects them
+    (by redirecting to the login page); the session then logs in again and
+    retries the request once. Timeouts, retries and rate limiting come from
+    httpclient.Session.
+    """
+
+    def __init__(self, churchname, username, password, siteid=None):
+        super().__init__()
+        self.churchname = churchname
+        self.username = username
+        self.password = password
+        self.siteid = siteid
+        self.site_id = None
+        self.path = get_session_path(churchname, username, siteid)
+        self.lock = threading.Lock()
+        # Bumped on every login, so concurrent requests rejected by the
+        # same stale session only trigger one fresh login
+        self.generation = 0
+
+    def start(self):
+        state = load_state(self.path)
+        if state is None:
+            self.authenticate()
+        else:
+            print('Reusing cached login')
+            for cookie in state['cookies']:
+                self.cookies.set_cookie(cookie)
+            self.site_id = state['site_id']
+        self.switch_site(self.siteid)
+
+    def authenticate(self):
+        print('Logging in via {}'.format(LOGIN_URL))
+        self.cookies.clear()
+        login_response = super().request(
+            'POST',
+            LOGIN_URL,
+            data={
+                'username': self.username,
+                'password': self.password,
+                'system': 'admin',
+                },
+            cookies={
+                'churchapp_login_account': self.churchname
+            }
+        )
+        if login_response.url == LOGIN_URL:
+            raise LoginError('login failed for {} at {}'.format(
+                self.username, self.churchname))
+        print('Login OK')
+        self.site_id = None
+        self.generation += 1
+        self.save()
+
+    def switch_site(self, siteid):
+        if siteid is None or siteid == self.site_id:
+            return
+        print('Switching site to: {}'.format(siteid))
+        super().request(
+            'PUT',
+            SITE_SWITCHER_URL.format(churchname=self.churchname),
+            data={
+                'site_id': siteid,
+            },
+        )
+        self.site_id = siteid
+        self.save()
+
+    def save(self):
+        save_state(self.path, self.cookies, self.site_id)
+
+    def is_rejected(self, response):
+        return urlparse(response.url).netloc == urlparse(LOGIN_URL).netloc
+
+    def request(self, method, url, *args, **kwargs):
+        generation = self.generation
+        response = super().request(method, url, *args, **kwargs)
+        if not self.is_rejected(response):
+            return response
+
+        with self.lock:
+            if self.generation == generation:
+                print('Cached login rejected - logging in again')
+                self.authenticate()
+                self.switch_site(self.siteid)
+        return super().request(method, url, *args, **kwargs)
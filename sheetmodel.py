@@ -0,0 +1,104 @@
+from string import ascii_uppercase
+
+
+def column_letter(index):
+    """
+    A1 column letters for a zero-based column index (0 -> A, 26 -> AA)
+    """
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = ascii_uppercase[remainder] + letters
+    return letters
+
+
+def cell_ref(sheet_name, row_num, col_index, width=1):
+    """
+    A1 reference to a cell (or a run of width cells along a row) on a sheet.
+    Rows are numbered from 1, columns indexed from 0.
+    """
+    ref = "'{}'!{}{}".format(sheet_name, column_letter(col_index), row_num)
+    if width > 1:
+        ref += ':{}{}'.format(column_letter(col_index + width - 1), row_num)
+    return ref
+
+
+def diff_cells(old_rows, new_rows):
+    """
+    Compare two grids of values (as strings) and return the changed cells
+    as runs along each row: (row number, first column index, new values).
+
+    Cells missing from the new grid are returned as blanks.
+    """
+    runs = []
+    for row_index in range(max(len(old_rows), len(new_rows))):
+        old_row = old_rows[row_index] if row_index < len(old_rows) else []
+        new_row = new_rows[row_index] if row_index < len(new_rows) else []
+        start = None
+        values = []
+        for col_index in range(max(len(old_row), len(new_row))):
+            old = str(old_row[col_index]) if col_index < len(old_row) else ''
+            new = str(new_row[col_index]) if col_index < len(new_row) else ''
+            if old != new:
+                if start is None:
+                    start = col_index
+                    values = []
+                values.append(new)
+            elif start is not None:
+                runs.append((row_index + 1, start, values))
+                start = None
+        if start is not None:
+            runs.append((row_index + 1, start, values))
+    return runs
+
+
+class SheetGrid:
+    """
+    Values read from a sheet, indexed once for lookups by row label (the
+    first cell of each row) and by column heading
+    """
+
+    def __init__(self, sheet_name, rows):
+        self.sheet_name = sheet_name
+        self.rows = rows
+        self.row_nums = {}
+        for row_num, row in enumerate(rows, start=1):
+            if row:
+                # First match wins, as with a top-down scan
+                self.row_nums.setdefault(row[0], row_num)
+        self.column_maps = {}
+
+    def find_row(self, label):
+        """
+        Row number (from 1) of the first row labelled label, or None
+        """
+        return self.row_nums.get(label)
+
+    def get_row(self, label):
+        row_num = self.find_row(label)
+        if row_num is None:
+            return None
+        return self.rows[row_num - 1]
+
+    def columns(self, label):
+        """
+        {heading: column index} for the headings in the row labelled label
+        """
+        if label not in self.column_maps:
+            columns = {}
+            for col_index, heading in enumerate(self.get_row(label) or []):
+                columns.setdefault(heading, col_index)
+            self.column_maps[label] = columns
+        return self.column_maps[label]
+
+    def cells(self):
+        """
+        Yield (row number, column index, value) for every cell
+        """
+        for row_num, row in enumerate(self.rows, start=1):
+            for col_index, value in enumerate(row):
+                yield row_num, col_index, value
+
+    def cell_ref(self, row_num, col_index, width=1):
+        return cell_ref(self.sheet_name, row_num, col_index, width)
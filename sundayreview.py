@@ -1,47 +1,70 @@
 #!/usr/bin/python3
 import json
 import sys
-from datetime import datetime
-from string import ascii_uppercase
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
 
-import dateutil
+import cache
+import dateutil.parser
 import drive
+import metrics
+from attendancestore import AttendanceStore
+from core import get_timestamp, login, now
 from dateutil import relativedelta
 from lxml import html
-from masterrota import login
+from sessioncache import LoginError
+from sheetmodel import SheetGrid, cell_ref, column_letter
 
 SHEETS_ROOT_URL = 'https://docs.google.com/spreadsheets/d/'
-
-
-def get_timestamp():
-    return datetime.now().strftime('%Y-%m-%d %H:%M')
+ATTENDANCE_URL = (
+    'https://{churchname}.churchsuite.co.uk/modules/'
+    'attendance/date_view.php?date={date}'
+)
+SUMMARY_SHEET = 'Last Sunday Summary'
+RESPONSES_SHEET = 'Form responses 1'
+HISTORY_SHEET = 'Attendance History'
+# Google Forms timestamps, e.g. 14/01/2018 10:31:05
+RESPONSE_DATE_FORMAT = '%d/%m/%Y'
+# Concurrent date_view requests when backfilling
+FETCH_WORKERS = 4
 
 
 def get_text(elem):
     """Grab cleaned text from an etree element"""
     return elem.text_content().strip()
 
-def get_attendance(churchname, username, password, date, siteid=None):
+
+@metrics.timed('fetch')
+def fetch_attendance_page(session, churchname, date):
+    attendance_url = ATTENDANCE_URL.format(
+        churchname=churchname,
+        date=date.strftime('%Y-%m-%d'),
+    )
+    print('Reading attendance figures from {}'.format(attendance_url))
+    response = session.get(attendance_url)
+    response.raise_for_status()
+    return response.content
+
+
+def get_attendance(churchname, username, password, date, siteid=None,
+                   session=None):
     """
     Get attendance figures for the given date
     """
-    datestr = date.strftime('%Y-%m-%d')
-    print('Getting attendance for {}'.format(datestr))
-
-    attendance_url = (
-        'https://{churchname}.churchsuite.co.uk/modules/'
-        'attendance/date_view.php?date={date}'.format(
-            churchname=churchname,
-            date=datestr,
-        )
-    )
+    print('Getting attendance for {}'.format(date.strftime('%Y-%m-%d')))
 
-    session = login(churchname, username, password, siteid)
+    if session is None:
+        session = login(churchname, username, password, siteid)
 
-    print('Reading attendance figures from {}'.format(attendance_url))
-    response = session.get(attendance_url)
+    return parse_attendance(fetch_attendance_page(session, churchname, date))
 
-    tree = html.fromstring(response.content)
+
+@metrics.timed('parse')
+def parse_attendance(content):
+    """
+    Read {meeting: {group: count}} from an attendance date_view page
+    """
+    tree = html.fromstring(content)
     site_rows = tree.cssselect('div.week-category')
 
     attendance = {}
@@ -64,168 +87,260 @@ def get_attendance(churchname, username, password, date, siteid=None):
     return attendance
 
 
-def get_responses(sheetid, range_name, date):
-    print('Getting responses data for {}'.format(date))
+def get_response_cache_file(sheetid):
+    return 'responses-{}.json'.format(sheetid)
 
-    service = drive.get_service()
-
-    sheet_data = service.spreadsheets().values().get(
-        spreadsheetId=sheetid,
-        range=range_name
-    ).execute()
-
-    responses = []
-
-    # Skip the header row
-    for row in sheet_data['values'][1:]:
-        rowdate = dateutil.parser.parse(
-            row[0], dayfirst=True,
-        ).date()
-        if rowdate == date:
-            responses.append(row)
-
-    return responses
-
-
-def clear_sheet(sheetid, test_func):
-    service = drive.get_service()
-    sheet_data = service.spreadsheets().values().get(
-        spreadsheetId=sheetid,
-        range="Last Sunday Summary",
-    ).execute()
-
-    sheet_rows = sheet_data['values']
-    for rindex, row in enumerate(sheet_rows, start=1):
-        for cindex, col in enumerate(row):
-            if test_func(col):
-                colname = ascii_uppercase[cindex]
-                update_cell(
-                    sheetid,
-                    "'Last Sunday Summary'!{col}{row}".format(
-                        col=colname,
-                        row=rindex,
-                    ),
-                    '')
-
-
-def update_cell(sheetid, cellref, data):
-    body = {
-        'values': [
-            [data, ],
-        ]
-    }
-    service = drive.get_service()
-    service.spreadsheets().values().update(
-        spreadsheetId=sheetid,
-        body=body,
-        valueInputOption='USER_ENTERED',
-        range=cellref,
-    ).execute()
-
-
-def update_sheet_dates(sheetid, thedate):
-    update_cell(
-        sheetid,
-        "'Last Sunday Summary'!B2",
-        get_timestamp(),
-    )
-    update_cell(
-        sheetid,
-        "'Last Sunday Summary'!B3",
-        thedate.strftime('%A %d %b %Y')
+
+def load_response_index(sheetid, refresh=False):
+    """
+    Form responses seen on earlier runs, indexed by date: the number of
+    sheet rows read so far (the watermark), the last of those rows, the
+    width of the header row, and {YYYY-MM-DD: [row, ...]}
+    """
+    empty = {'rows': 0, 'last': None, 'width': None, 'dates': {}}
+    if refresh:
+        return empty
+    return cache.load_json(get_response_cache_file(sheetid), empty)
+
+
+def responses_header_range():
+    return "'{}'!1:1".format(RESPONSES_SHEET)
+
+
+def responses_range(index):
+    """
+    Range covering the responses added since the index was saved. It starts
+    at the last row already indexed, so that row can be checked for edits,
+    and is as wide as the header row, so it always lies within the sheet.
+    With nothing indexed yet, the whole sheet is read.
+    """
+    if not index['rows'] or not index.get('width'):
+        return "'{}'".format(RESPONSES_SHEET)
+    return "'{}'!A{}:{}".format(
+        RESPONSES_SHEET,
+        index['rows'],
+        column_letter(index['width'] - 1),
     )
 
 
-def find_row_by_label(rows, label):
+def parse_response_date(value):
+    try:
+        return datetime.strptime(
+            value.split(' ', 1)[0], RESPONSE_DATE_FORMAT).date()
+    except ValueError:
+        return dateutil.parser.parse(value, dayfirst=True).date()
+
+
+def index_responses(index, rows):
+    """
+    Add rows appended to the responses sheet (from row index['rows'] + 1
+    onwards) to the index
+    """
+    for row_num, row in enumerate(rows, start=index['rows'] + 1):
+        if row_num == 1:
+            index['width'] = len(row)
+            continue
+        # Skip blank rows
+        if not row:
+            continue
+        key = parse_response_date(row[0]).strftime('%Y-%m-%d')
+        index['dates'].setdefault(key, []).append(row)
+    if rows:
+        index['rows'] += len(rows)
+        index['last'] = rows[-1]
+
+
+def update_response_index(sheetid, index, header, rows):
+    """
+    Bring the index up to date from the header row and the rows read via
+    responses_range, then save it. If the previously last row has changed,
+    responses were edited or removed, and if the header has changed width,
+    questions were added or removed; either way the whole sheet is re-read.
+    """
+    if index['rows']:
+        width = len(header[0]) if header else 0
+        if (not rows or rows[0] != index['last'] or
+                width != index.get('width')):
+            print('Form responses changed - re-reading all responses')
+            index = load_response_index(sheetid, refresh=True)
+            rows = drive.read_values(sheetid, RESPONSES_SHEET)
+        else:
+            rows = rows[1:]
+    index_responses(index, rows)
+    cache.save_json(get_response_cache_file(sheetid), index)
+    return index
+
+
+def get_responses(index, date):
     """
-    Pull a single row from tabular data (rows and columns aka a list of lists)
-    using the value of the first column
+    Form responses submitted on date
     """
-    for row_num, row in enumerate(rows, start=1):
-        if row[0] == label:
-            return row_num, row
+    print('Getting responses data for {}'.format(date))
+    return index['dates'].get(date.strftime('%Y-%m-%d'), [])
+
+
+def clear_sheet(writer, grid, test_func):
+    for row_num, col_index, value in grid.cells():
+        if test_func(value):
+            writer.update_cell(grid.cell_ref(row_num, col_index), '')
 
 
-def update_sheet_numbers(sheetid, attendance_data):
-    service = drive.get_service()
-    sheet_data = service.spreadsheets().values().get(
-        spreadsheetId=sheetid,
-        range="Last Sunday Summary",
-    ).execute()
+def update_sheet_dates(writer, thedate):
+    writer.update_cell(
+        cell_ref(SUMMARY_SHEET, 2, 1),
+        get_timestamp(),
+    )
+    writer.update_cell(
+        cell_ref(SUMMARY_SHEET, 3, 1),
+        thedate.strftime('%A %d %b %Y')
+    )
 
-    sheet_rows = sheet_data['values']
 
-    _, heading_row = find_row_by_label(sheet_rows, 'Attendance')
+def update_sheet_numbers(writer, grid, attendance_data):
+    meeting_columns = grid.columns('Attendance')
 
     for meeting_name, meeting_attendance in attendance_data.items():
-        if meeting_name not in heading_row:
+        meeting_column = meeting_columns.get(meeting_name)
+        if meeting_column is None:
             print('Skipping meeting not in output sheet: {}'.format(
                 meeting_name,
             ))
             continue
 
-        # Look up the column letter for this meeting
-        meeting_column = ascii_uppercase[
-            heading_row.index(meeting_name)
-        ]
-
         for groupname, attendance_value in meeting_attendance.items():
-            try:
-                group_row_num, _ = find_row_by_label(sheet_rows, groupname)
-            except TypeError:
+            group_row_num = grid.find_row(groupname)
+            if group_row_num is None:
                 print('Skipping group not in output sheet: {}'.format(
                     groupname,
                 ))
                 continue
 
-            # print('Writing {} to {}{}'.format(
-            #     attendance_value,
-            #     meeting_column,
-            #     group_row_num,
-            # ))
-            update_cell(
-                sheetid,
-                "'Last Sunday Summary'!{col}{row}".format(
-                    col=meeting_column,
-                    row=group_row_num,
-                ),
+            writer.update_cell(
+                grid.cell_ref(group_row_num, meeting_column),
                 attendance_value,
             )
 
 
-if __name__ == "__main__":
+def get_sundays(fromdate, todate):
+    """
+    Every Sunday from fromdate to todate (inclusive)
+    """
+    sunday = fromdate + relativedelta.relativedelta(
+        weekday=relativedelta.SU(+1))
+    sundays = []
+    while sunday <= todate:
+        sundays.append(sunday)
+        sunday += timedelta(weeks=1)
+    return sundays
+
+
+def history_rows(history):
+    """
+    Rows for the history sheet from [(date, attendance), ...]: a row per
+    date and a column per meeting and group
+    """
+    columns = {}
+    for _, attendance in history:
+        for meeting_name, meeting_attendance in attendance.items():
+            for groupname in meeting_attendance:
+                columns.setdefault((meeting_name, groupname), len(columns))
+
+    rows = [
+        ['Date', ] + [
+            '{} - {}'.format(meeting_name, groupname)
+            for meeting_name, groupname in columns
+        ],
+    ]
+    for date, attendance in history:
+        row = [date.strftime('%Y-%m-%d'), ] + [''] * len(columns)
+        for meeting_name, meeting_attendance in attendance.items():
+            for groupname, value in meeting_attendance.items():
+                row[columns[(meeting_name, groupname)] + 1] = value
+        rows.append(row)
+    return rows
+
+
+def backfill(config, fromdate, todate):
+    """
+    Rebuild attendance history for every Sunday in a date range.
+
+    Logs in once, fetches the date_view pages concurrently, parses them in
+    a process pool and writes the whole history to the history sheet in a
+    single batch.
+    """
+    sundays = get_sundays(fromdate, todate)
+    print('Backfilling attendance for {} Sundays'.format(len(sundays)))
+    session = login(
+        config['churchname'],
+        config['username'],
+        config['password'],
+        config.get('site_id', None),
+    )
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        pages = list(executor.map(
+            lambda date: fetch_attendance_page(
+                session, config['churchname'], date),
+            sundays,
+        ))
+    with ProcessPoolExecutor() as executor:
+        history = list(zip(sundays, executor.map(parse_attendance, pages)))
+    store_attendance(config, history)
+
+    sheet_name = config.get('history_sheet', HISTORY_SHEET)
+    writer = drive.BatchWriter(config['google_sheet_id'])
+    writer.clear(sheet_name)
+    writer.update(sheet_name, history_rows(history))
+    writer.flush()
+    return history
+
+
+def store_attendance(config, history):
+    """
+    Append [(date, attendance), ...] to the local attendance store
+    (attendance_db in the config, or one in the cache directory)
+    """
+    path = config.get('attendance_db') or cache.get_cache_path(
+        'attendance-{}.sqlite'.format(config['churchname']))
+    store = AttendanceStore(path)
     try:
-        configfile = sys.argv[1]
-    except IndexError:
-        print('Please provide a JSON config file')
-        sys.exit(1)
+        for date, attendance in history:
+            store.add(date, attendance)
+    finally:
+        store.close()
 
-    with open(configfile, 'r') as f:
-        config = json.load(f)
 
-    sheetid = config['google_sheet_id']
+def isnum(data):
+    try:
+        int(data)
+    except ValueError:
+        return False
+    else:
+        return True
 
-    now = datetime.now()
-    last_sunday = (
-        now + relativedelta.relativedelta(
-            weekday=relativedelta.SU(-1))
-    ).date()
 
-    last_sunday = datetime(2018, 6, 17)
+def review(config, date, refresh_responses=False):
+    """
+    Sunday review: write attendance for date to the summary sheet and
+    list that day's form responses
+    """
+    sheetid = config['google_sheet_id']
 
-    print('Sunday review for last sunday ({})'.format(
-        last_sunday,
+    print('Sunday review for {}'.format(
+        date,
     ))
 
     attendance = get_attendance(
         config['churchname'],
         config['username'],
         config['password'],
-        last_sunday,
+        date,
+        config.get('site_id', None),
     )
 
     if not attendance:
         print('No attendance figures')
+    else:
+        store_attendance(config, [(date, attendance), ])
     for meeting_name, meeting_attendance in attendance.items():
         print(
             '{meeting_name}:\t{total}'.format(
@@ -234,32 +349,38 @@ if __name__ == "__main__":
             )
         )
 
-    def isnum(data):
-        try:
-            int(data)
-        except ValueError:
-            return False
-        else:
-            return True
+    # Every stage works from one snapshot of the sheets it needs, which
+    # only includes the form responses added since the last run
+    response_index = load_response_index(sheetid, refresh_responses)
+    responses_header = responses_header_range()
+    new_responses = responses_range(response_index)
+    snapshot = drive.read_ranges(
+        sheetid, [SUMMARY_SHEET, responses_header, new_responses])
+    summary = SheetGrid(SUMMARY_SHEET, snapshot[SUMMARY_SHEET])
+
+    # All cell edits are buffered and sent in a single batch
+    writer = drive.BatchWriter(sheetid)
 
     # Clear numbers from sheet
-    clear_sheet(sheetid, isnum)
+    clear_sheet(writer, summary, isnum)
 
     # Update the sunday heading and timestamp
     update_sheet_dates(
-        sheetid,
-        last_sunday,
+        writer,
+        date,
     )
 
     # Write attendance to the google sheet
-    sheetid = config['google_sheet_id']
-    update_sheet_numbers(sheetid, attendance)
+    update_sheet_numbers(writer, summary, attendance)
+    writer.flush()
 
-    responses = get_responses(
+    response_index = update_response_index(
         sheetid,
-        "Form responses 1",
-        last_sunday,
+        response_index,
+        snapshot[responses_header],
+        snapshot[new_responses],
     )
+    responses = get_responses(response_index, date)
 
     if responses:
         print('Responses: ')
@@ -267,3 +388,53 @@ if __name__ == "__main__":
             print(', '.join(response))
 
     print('Changes written to: {}{}'.format(SHEETS_ROOT_URL, sheetid))
+
+
+def get_last_sunday():
+    return (
+        now() + relativedelta.relativedelta(
+            weekday=relativedelta.SU(-1))
+    ).date()
+
+
+def parse_date_arg(name):
+    """
+    Read a YYYY-MM-DD date following the given flag on the command line
+    """
+    try:
+        value = sys.argv[sys.argv.index(name) + 1]
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except (IndexError, ValueError):
+        print('Please provide a YYYY-MM-DD date after {}'.format(name))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    try:
+        configfile = sys.argv[1]
+    except IndexError:
+        print('Please provide a JSON config file')
+        sys.exit(1)
+
+    with open(configfile, 'r') as f:
+        config = json.load(f)
+
+    try:
+        if '--backfill' in sys.argv:
+            backfill(
+                config,
+                parse_date_arg('--backfill'),
+                parse_date_arg('--to') if '--to' in sys.argv else
+                get_last_sunday(),
+            )
+        else:
+            review(
+                config,
+                parse_date_arg('--date') if '--date' in sys.argv else
+                get_last_sunday(),
+                '--refresh-responses' in sys.argv,
+            )
+    except LoginError as e:
+        print('Error - {}'.format(e))
+        sys.exit(1)
+    metrics.write_report(config, 'sundayreview')
@@ -1,9 +1,16 @@
 #!/usr/bin/python3
 import json
 import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from itertools import islice
 
-import emails
-import requests
+import cache
+import httpclient
+import metrics
+from core import get_item_configs
+from mailer import OK_STATUS, Mailer
 
 API_ROOT = 'https://api.churchsuite.co.uk/v1'
 CONTACT_URL_TEMPLATE = (
@@ -14,115 +21,386 @@ TAG_REPORT_TEMPLATE = (
     'https://{account}.churchsuite.co.uk/modules/'
     'addressbook/tag_view.php?id={tag_id}'
 )
+PAGE_SIZE = 100
+# Contacts listed individually in an alert (the rest are summarised)
+MAX_LISTED = 100
+# Concurrent API requests in multi-tag mode
+TAG_WORKERS = 8
+INTRO_HTML = "<p>This is an automated email generated by 'tagalert'.</p>\n"
+TAG_HTML = """<p>
+Tag: <b>{tag_name}</b>
+<br />
+Matches: <b>{total}</b>
+</p>
+
+<p>
+<a href="{tag_view}">View full tag report on ChurchSuite</a>
+</p>
+
+<p>
+Match details:
+<br />
+{contacts}
+</p>
+"""
+CHANGES_HTML = """<b>New matches: {added_total}</b>
+<br />
+{added}
+<br />
+<b>No longer matching: {removed_total}</b>
+<br />
+{removed}
+"""
+
+
+def get_state_file(config):
+    return 'tagalert-{}-{}.json'.format(config['account'], config['tagid'])
+
+
+def load_tag_state(config):
+    """
+    What tagalert saw for this tag on its last run: the matching contacts
+    and the cache validators (ETag/Last-Modified) and data for each page
+    """
+    return cache.load_json(get_state_file(config), {
+        'contacts': None,
+        'pages': {},
+    })
+
+
+def save_tag_state(config, state):
+    cache.save_json(get_state_file(config), state)
+
 
+def trim_contact(contact):
+    return {
+        'id': contact['id'],
+        'first_name': contact['first_name'],
+        'last_name': contact['last_name'],
+    }
 
-def search_tag(config):
-    tag_url = "{}/addressbook/tag/{}?contacts=true".format(
+
+def trim_page(data):
+    """
+    The parts of a search_tag page that tagalert uses
+    """
+    return {
+        'name': data.get('name'),
+        'tag_no_contacts': data.get('tag_no_contacts'),
+        'contacts': [
+            trim_contact(contact) for contact in data.get('contacts') or []
+        ],
+    }
+
+
+def search_tag(config, page=1, session=None, state=None):
+    """
+    Tag details, with one page of its contacts.
+
+    Given a tag state (see load_tag_state), the request is conditional on
+    the page having changed since it was last fetched.
+    """
+    tag_url = "{}/addressbook/tag/{}?contacts=true&page={}&per_page={}".format(  # noqa
         API_ROOT,
         config['tagid'],
+        page,
+        PAGE_SIZE,
     )
-    response = requests.get(
-        tag_url,
-        headers={
-            'X-Account': config['account'],
-            'X-Auth': config['apikey'],
-            'X-Application': 'tagalert',
-            'Content-Type': 'application/json',
-        }
-    )
-    if response.status_code == 200:
-        return response.json()
+    headers = {
+        'X-Account': config['account'],
+        'X-Auth': config['apikey'],
+        'X-Application': 'tagalert',
+        'Content-Type': 'application/json',
+    }
+    cached = None
+    if state is not None:
+        cached = state['pages'].get(str(page))
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    response = (session or httpclient.get_session()).get(
+        tag_url, headers=headers)
+    if response.status_code == 304 and cached:
+        return cached['data']
+    elif response.status_code == 200:
+        data = response.json()
+        if state is not None:
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            if etag or last_modified:
+                state['pages'][str(page)] = {
+                    'etag': etag,
+                    'last_modified': last_modified,
+                    'data': trim_page(data),
+                }
+        return data
     else:
-        print('Got {} response from {}'.format(
+        print(response.text)
+        raise IOError('Got {} response from {}'.format(
             response.status_code,
             tag_url,
-            ))
-        print(response.text)
-        sys.exit(1)
+        ))
+
 
+def iter_contacts(config, data, session=None, state=None):
+    """
+    Yield a tag's contacts, starting from the first page of search_tag
+    results and fetching later pages only as they are needed
+    """
+    page = 1
+    previous = None
+    while True:
+        contacts = data.get('contacts') or []
+        # Guard against an API that ignores paging repeating page one
+        if not contacts or contacts[0] == previous:
+            return
+        yield from contacts
+        # A short page is the last one; an oversized one means the API
+        # returned every contact at once
+        if len(contacts) != PAGE_SIZE:
+            return
+        previous = contacts[0]
+        page += 1
+        data = search_tag(config, page, session, state)
 
-def notify(config, tag_name, contacts):
+
+def render_contacts(config, contacts, total):
+    """
+    HTML list of contact links, capped at max_listed with a summary of
+    the remainder. Only the listed contacts are read from the iterator.
+    """
     contact_string = (
         "<a href='{contact_url}'>"
         "{contact[first_name]} {contact[last_name]}"
         "</a>"
     )
-    contact_html = '<br />'.join(
-        contact_string.format(
+    max_listed = config.get('max_listed', MAX_LISTED)
+    html = StringIO()
+    listed = 0
+    for contact in islice(contacts, max_listed):
+        if listed:
+            html.write('<br />')
+        html.write(contact_string.format(
             contact_url=CONTACT_URL_TEMPLATE.format(
                 account=config['account'],
                 contact_id=contact['id'],
             ),
-            contact=contact)
-        for contact in contacts
-    )
-    html = """<p>This is an automated email generated by 'tagalert'.</p>
-<p>
-Tag: <b>{tag_name}</b>
-<br />
-Matches: <b>{total}</b>
-</p>
+            contact=contact))
+        listed += 1
+    if total > listed:
+        html.write('<br />... and {} more'.format(total - listed))
+    return html.getvalue()
 
-<p>
-<a href="{tag_view}">View full tag report on ChurchSuite</a>
-</p>
 
-<p>
-Match details:
-<br />
-{contacts}
-</p>
-""".format(
-      tag_name=tag_name,
-      total=len(contacts),
-      tag_view=TAG_REPORT_TEMPLATE.format(
-          account=config['account'],
-          tag_id=config['tagid'],
-      ),
-      contacts=contact_html,
+def render_tag(config, tag_name, contacts, total):
+    return TAG_HTML.format(
+        tag_name=tag_name,
+        total=total,
+        tag_view=TAG_REPORT_TEMPLATE.format(
+            account=config['account'],
+            tag_id=config['tagid'],
+        ),
+        contacts=render_contacts(config, contacts, total),
     )
-    smtp = config['smtp']
+
+
+@metrics.timed('notify')
+def send_alert(smtp, html, tag_names, subscribers, mailer=None):
+    """
+    Email an alert to the subscribers. Returns {address: status}.
+    """
+    # Imported here, as most runs have nothing to send
+    import emails
     message = emails.html(
-        html=html,
-        subject='ChurchSuite Tag Alert: {}'.format(tag_name),
+        html=INTRO_HTML + html,
+        subject='ChurchSuite Tag Alert: {}'.format(', '.join(tag_names)),
         mail_from=smtp.get('user'),
     )
-    for address in config['subscribers']:
-        response = message.send(
-            to=address,
-            smtp={
-                "host": smtp.get('host'),
-                "ssl": smtp.get('ssl', False),
-                "port": smtp.get('port', 25),
-                "user": smtp.get('user', None),
-                "password": smtp.get('password', None),
-            }
-        )
-        print('Notifying {} ({})'.format(address, response.status_code))
+    if mailer is None:
+        with Mailer(smtp) as mailer:
+            return mailer.send(message, subscribers)
+    return mailer.send(message, subscribers)
 
 
-if __name__ == "__main__":
+@metrics.timed('fetch')
+def check_tag(config, session=None):
+    """
+    Look up a tag. Returns None if there's nothing to report, False if the
+    tag couldn't be checked, otherwise (tag name, total, rendered HTML,
+    state to save once notified).
+
+    With only_changes set, the alert covers contacts added or removed since
+    the last run, and is skipped when there are none.
+    """
     try:
-        configfile = sys.argv[1]
-    except IndexError:
-        print('Please provide a JSON config file')
-        sys.exit(1)
-    with open(configfile, 'r') as f:
-        config = json.load(f)
+        if config.get('only_changes'):
+            return check_tag_changes(config, session)
+        return check_tag_matches(config, session)
+    except IOError as e:
+        # requests' errors are IOErrors too
+        print('Error checking tag {}: {}'.format(config['tagid'], e))
+        return False
 
-    data = search_tag(config)
-    contacts = data['contacts']
-    tag_name = data['name']
 
+def check_tag_matches(config, session=None):
+    data = search_tag(config, session=session)
+    tag_name = data['name']
     total = int(data['tag_no_contacts'] or 0)
     if total <= 0:
         print('No contacts found for tag: {}'.format(
             tag_name,
         ))
-    else:
-        print('Found {} contacts for tag: {}'.format(
-            total,
+        return None
+    print('Found {} contacts for tag: {}'.format(
+        total,
+        tag_name,
+    ))
+    contacts = iter_contacts(config, data, session)
+    html = render_tag(config, tag_name, contacts, total)
+    return tag_name, total, html, None
+
+
+def check_tag_changes(config, session=None):
+    state = load_tag_state(config)
+    data = search_tag(config, session=session, state=state)
+    tag_name = data['name']
+    current = OrderedDict(
+        (str(contact['id']), trim_contact(contact))
+        for contact in iter_contacts(config, data, session, state)
+    )
+    # First run: everyone is new
+    previous = state['contacts'] or {}
+    added = [
+        contact for key, contact in current.items() if key not in previous
+    ]
+    removed = [
+        contact for key, contact in previous.items() if key not in current
+    ]
+    state['contacts'] = current
+
+    if not (added or removed):
+        print('No changes for tag: {} ({} contacts)'.format(
             tag_name,
+            len(current),
         ))
-        notify(config, tag_name, contacts)
+        save_tag_state(config, state)
+        return None
+    print('{} added and {} removed for tag: {}'.format(
+        len(added),
+        len(removed),
+        tag_name,
+    ))
+    html = TAG_HTML.format(
+        tag_name=tag_name,
+        total=len(current),
+        tag_view=TAG_REPORT_TEMPLATE.format(
+            account=config['account'],
+            tag_id=config['tagid'],
+        ),
+        contacts=CHANGES_HTML.format(
+            added_total=len(added),
+            added=render_contacts(config, added, len(added)),
+            removed_total=len(removed),
+            removed=render_contacts(config, removed, len(removed)),
+        ),
+    )
+    return tag_name, len(current), html, state
+
+
+def run_tags(config):
+    """
+    Check every tag in a multi-tag config concurrently over one pooled
+    session, then send each subscriber a single digest covering all of
+    their tags that have matches (per smtp setting, as tags can override
+    it). Returns False if any tag couldn't be checked.
+    """
+    tags = get_item_configs(config, 'tags')
+    with httpclient.Session(pool_size=TAG_WORKERS) as session:
+        with ThreadPoolExecutor(max_workers=TAG_WORKERS) as executor:
+            alerts = list(executor.map(
+                lambda tag: check_tag(tag, session),
+                tags,
+            ))
+
+    # Subscribers following the same set of matching tags (with the same
+    # smtp settings) share a digest, so each distinct digest is only
+    # rendered once
+    subscriber_tags = OrderedDict()
+    for index, (tag, alert) in enumerate(zip(tags, alerts)):
+        if not alert:
+            continue
+        smtp_key = json.dumps(tag.get('smtp'), sort_keys=True)
+        for address in tag['subscribers']:
+            subscriber_tags.setdefault(
+                (smtp_key, address), []).append(index)
+    digests = OrderedDict()
+    for (smtp_key, address), indexes in subscriber_tags.items():
+        digests.setdefault((smtp_key, tuple(indexes)), []).append(address)
+
+    # A tag's state is only saved once its alert has reached someone, so a
+    # failed send is retried next run
+    delivered = set()
+    mailers = {}
+    try:
+        for (smtp_key, indexes), subscribers in digests.items():
+            smtp = tags[indexes[0]]['smtp']
+            if smtp_key not in mailers:
+                mailers[smtp_key] = Mailer(smtp)
+            statuses = send_alert(
+                smtp,
+                '\n'.join(alerts[index][2] for index in indexes),
+                [alerts[index][0] for index in indexes],
+                subscribers,
+                mailers[smtp_key],
+            )
+            if OK_STATUS in statuses.values():
+                delivered.update(indexes)
+    finally:
+        for mailer in mailers.values():
+            mailer.close()
+
+    for index, (tag, alert) in enumerate(zip(tags, alerts)):
+        if index in delivered and alert[3] is not None:
+            save_tag_state(tag, alert[3])
+    return False not in alerts
+
+
+def run(config):
+    alert = check_tag(config)
+    if alert is False:
+        return False
+    if alert is not None:
+        tag_name, _, html, state = alert
+        statuses = send_alert(
+            config['smtp'], html, [tag_name, ], config['subscribers'])
+        if state is not None and OK_STATUS in statuses.values():
+            save_tag_state(config, state)
+    return True
+
+
+def run_config(config):
+    """
+    Check the tag(s) in a config. Returns False if any couldn't be checked.
+    """
+    if 'tags' in config:
+        return run_tags(config)
+    return run(config)
+
+
+if __name__ == "__main__":
+    try:
+        configfile = sys.argv[1]
+    except IndexError:
+        print('Please provide a JSON config file')
+        sys.exit(1)
+    with open(configfile, 'r') as f:
+        config = json.load(f)
+
+    ok = run_config(config)
+    metrics.write_report(config, 'tagalert')
+    if not ok:
+        sys.exit(1)
     print('Done')